@@ -0,0 +1,110 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import requests
+import shapely
+from shapely.geometry import shape
+from sqlalchemy import text
+
+from backend.metrics import metrics
+from backend.shared import app, db, db_dir, EMAIL, logger
+
+# written by scripts/fetch-countries.py
+COUNTRY_BOUNDARIES = os.path.join(db_dir, "countries.geojson")
+
+# country code for spots that aren't in any country, e.g. at sea
+UNKNOWN_COUNTRY = "XZ"
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/reverse"
+NOMINATIM_TIMEOUT = 10
+NOMINATIM_ATTEMPTS = 5
+# seconds between requests, the usage policy allows at most one per second
+NOMINATIM_INTERVAL = 1.1
+
+_index = None
+_index_lock = threading.Lock()
+_enrichment_queue = queue.Queue()
+_enrichment_thread = None
+_last_nominatim_request = 0.0
+
+
+def load_country_index():
+    """Country polygons and an STRtree over them, or None if the boundaries file was missing on first use."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            if not os.path.exists(COUNTRY_BOUNDARIES):
+                logger.warning(f"{COUNTRY_BOUNDARIES} is missing, run scripts/fetch-countries.py")
+                _index = False
+                return None
+            with open(COUNTRY_BOUNDARIES) as f:
+                features = json.load(f)["features"]
+            geometries = [shape(feature["geometry"]) for feature in features]
+            shapely.prepare(geometries)
+            codes = [feature["properties"]["country_code"] for feature in features]
+            _index = (shapely.STRtree(geometries), codes)
+        return _index or None
+
+
+def get_country(lat, lon):
+    """Country code of the spot from the local boundaries, None if it can't be resolved locally."""
+    index = load_country_index()
+    if index is None:
+        return None
+    tree, codes = index
+    matches = tree.query(shapely.Point(lon, lat), predicate="intersects")
+    return codes[min(matches)] if len(matches) else None
+
+
+def get_country_nominatim(lat, lon):
+    global _last_nominatim_request
+    for attempt in range(NOMINATIM_ATTEMPTS):
+        # only the enrichment thread sends requests, so they are spaced out across the queued lookups too
+        time.sleep(max(0, _last_nominatim_request + NOMINATIM_INTERVAL - time.monotonic()))
+        _last_nominatim_request = time.monotonic()
+        start = time.perf_counter()
+        try:
+            resp = requests.get(
+                NOMINATIM_URL,
+                {"lat": lat, "lon": lon, "format": "json", "zoom": 3, "email": EMAIL},
+                timeout=NOMINATIM_TIMEOUT,
+            )
+            metrics.observe_dependency("nominatim", time.perf_counter() - start)
+            if resp.ok:
+                res = resp.json()
+                return UNKNOWN_COUNTRY if "error" in res else res["address"]["country_code"].upper()
+            logger.info(resp)
+        except requests.RequestException as e:
+            logger.info(e)
+        if attempt < NOMINATIM_ATTEMPTS - 1:
+            time.sleep(2**attempt)
+    return None
+
+
+def enrich_countries():
+    while True:
+        pid, lat, lon = _enrichment_queue.get()
+        try:
+            country = get_country_nominatim(lat, lon)
+            if country and country != UNKNOWN_COUNTRY:
+                with app.app_context(), db.engine.begin() as conn:
+                    conn.execute(text("UPDATE points SET country = :country WHERE id = :id"), {"country": country, "id": pid})
+        except Exception:
+            logger.exception(f"Country enrichment of point {pid} failed")
+        finally:
+            _enrichment_queue.task_done()
+
+
+def enqueue_country_enrichment(pid, lat, lon):
+    """Look up the country of a point on Nominatim in the background and store it if it was found."""
+    global _enrichment_thread
+    if not app.config["COUNTRY_ENRICHMENT"]:
+        return
+    with _index_lock:
+        if _enrichment_thread is None:
+            _enrichment_thread = threading.Thread(target=enrich_countries, name="country-enrichment", daemon=True)
+            _enrichment_thread.start()
+    _enrichment_queue.put((pid, lat, lon))
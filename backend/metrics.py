@@ -0,0 +1,143 @@
+import bisect
+import cProfile
+import glob
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets in seconds, like the Prometheus client's defaults
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+# profiles kept per endpoint, older ones are removed
+PROFILES_KEPT = 50
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip([*map(str, BUCKETS), "+Inf"], self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {cumulative}"
+
+
+class Metrics:
+    """
+    Request latency, time spent in the database and in other services (e.g. Nominatim) per endpoint.
+    Observations come from the server's threads, so everything is behind one lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latency = {}
+        self.db_time = {}
+        self.db_queries = {}
+        self.dependencies = {}
+
+    def observe_request(self, endpoint, method, status, seconds, db_seconds, db_queries):
+        with self.lock:
+            key = (endpoint, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.latency.setdefault((endpoint, method), Histogram()).observe(seconds)
+            self.db_time.setdefault((endpoint, method), Histogram()).observe(db_seconds)
+            self.db_queries[(endpoint, method)] = self.db_queries.get((endpoint, method), 0) + db_queries
+
+    def observe_dependency(self, name, seconds):
+        with self.lock:
+            self.dependencies.setdefault(name, Histogram()).observe(seconds)
+
+    def render(self):
+        """All metrics in the Prometheus text format."""
+        with self.lock:
+            lines = ["# TYPE hitchmap_requests_total counter"]
+            lines += [
+                f'hitchmap_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}'
+                for (endpoint, method, status), count in sorted(self.requests.items())
+            ]
+            for name, histograms in [
+                ("hitchmap_request_duration_seconds", self.latency),
+                ("hitchmap_request_db_seconds", self.db_time),
+            ]:
+                lines.append(f"# TYPE {name} histogram")
+                for (endpoint, method), histogram in sorted(histograms.items()):
+                    lines += histogram.lines(name, f'endpoint="{endpoint}",method="{method}"')
+            lines.append("# TYPE hitchmap_request_db_queries_total counter")
+            lines += [
+                f'hitchmap_request_db_queries_total{{endpoint="{endpoint}",method="{method}"}} {count}'
+                for (endpoint, method), count in sorted(self.db_queries.items())
+            ]
+            lines.append("# TYPE hitchmap_dependency_duration_seconds histogram")
+            for name, histogram in sorted(self.dependencies.items()):
+                lines += histogram.lines("hitchmap_dependency_duration_seconds", f'dependency="{name}"')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class Profiler:
+    """
+    Profiles a sample of the requests to some endpoints with cProfile, or pyinstrument if it is installed and chosen.
+    Only one request is profiled at a time, the profilers can't run in several threads at once.
+    """
+
+    def __init__(self, directory, endpoints, sample_rate, kind="cprofile"):
+        self.directory = directory
+        self.endpoints = endpoints
+        self.sample_rate = sample_rate
+        self.kind = kind
+        self.lock = threading.Lock()
+        if kind == "pyinstrument":
+            try:
+                import pyinstrument  # noqa: F401
+            except ImportError:
+                logger.warning("pyinstrument isn't installed, profiling with cProfile")
+                self.kind = "cprofile"
+
+    def start(self, endpoint):
+        """A started profiler if this request was sampled, otherwise None."""
+        if endpoint not in self.endpoints or random.random() >= self.sample_rate or not self.lock.acquire(blocking=False):
+            return None
+        if self.kind == "pyinstrument":
+            from pyinstrument import Profiler as PyinstrumentProfiler
+
+            profiler = PyinstrumentProfiler()
+            start = profiler.start
+        else:
+            profiler = cProfile.Profile()
+            start = profiler.enable
+        try:
+            start()
+        except (RuntimeError, ValueError):
+            self.lock.release()
+            return None
+        return profiler
+
+    def stop(self, profiler, endpoint):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{endpoint}-{time.strftime('%Y%m%dT%H%M%S')}-{random.randrange(1000):03}")
+            if self.kind == "pyinstrument":
+                profiler.stop()
+                with open(path + ".html", "w") as f:
+                    f.write(profiler.output_html())
+            else:
+                profiler.disable()
+                profiler.dump_stats(path + ".prof")
+            for old in sorted(glob.glob(os.path.join(self.directory, f"{endpoint}-*")))[:-PROFILES_KEPT]:
+                os.remove(old)
+        finally:
+            self.lock.release()
@@ -0,0 +1,40 @@
+import threading
+import time
+
+# one review per 10 seconds, the browser sometimes submits the same form twice
+RATE_LIMIT_CAPACITY = 1
+RATE_LIMIT_PERIOD = 10
+
+# buckets that are full again are forgotten once there are this many
+MAX_BUCKETS = 10_000
+
+
+class TokenBucketLimiter:
+    """
+    In-process token bucket per key. Each key holds up to capacity tokens, one token comes back every period / capacity
+    seconds and every allowed request takes one.
+    """
+
+    def __init__(self, capacity=RATE_LIMIT_CAPACITY, period=RATE_LIMIT_PERIOD):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - allowed, now)
+            if len(self.buckets) > MAX_BUCKETS:
+                self.evict(now)
+        return allowed
+
+    def evict(self, now):
+        self.buckets = {
+            key: (tokens, updated)
+            for key, (tokens, updated) in self.buckets.items()
+            if tokens + (now - updated) * self.rate < self.capacity
+        }
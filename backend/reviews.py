@@ -0,0 +1,103 @@
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from backend.shared import ReloadingIndex, db_dir
+
+# written by scripts/show.py next to the spots, one row per visible review
+REVIEWS_FILE = os.path.join(db_dir, "reviews.pkl")
+
+# the smallest text the trigram index can look up, shorter texts are matched with a scan
+MIN_INDEXED_TEXT = 3
+
+
+def travel_angles(lat, lon, dest_lat, dest_lon):
+    """Angle of the ride from the spot to the destination as js/filters.js computes it, 0 is east and pi/2 is south."""
+    return np.arctan2(lat - dest_lat, dest_lon - lon)
+
+
+class ReviewIndex:
+    """
+    The reviews with an index for each filter of js/filters.js, so a search only touches the matching reviews:
+    reviews by lowercase user, sorted ride times, ride distances and travel angles to bisect and a trigram
+    full text index of the comments.
+    Filters return sorted positions of reviews, which are ordered newest first.
+    """
+
+    def __init__(self, reviews):
+        ride_time = reviews.ride_datetime.fillna(reviews.datetime)
+        self.reviews = reviews.assign(ride_time=ride_time).sort_values("ride_time", ascending=False, kind="stable")
+        self.reviews = self.reviews.reset_index(drop=True)
+        self.short_ids = self.reviews.short_id.to_numpy()
+        self.spot_ids = self.reviews.spot_id.to_numpy()
+
+        users = self.reviews.hitchhiker.str.lower()
+        self.users = {user: group.to_numpy() for user, group in users.index.to_series().groupby(users)}
+
+        self.ride_times, self.by_ride_time = self.sorted_values(self.reviews.ride_time.dropna().astype("int64"))
+        distances = self.reviews.ride_distance
+        self.distances, self.by_distance = self.sorted_values(distances[distances > 0])
+        angles = travel_angles(self.reviews.lat, self.reviews.lon, self.reviews.dest_lat, self.reviews.dest_lon)
+        self.angles, self.by_angle = self.sorted_values(angles.dropna())
+
+        self.comments = self.reviews.comment.str.lower()
+        # sqlite's trigram tokenizer makes a phrase query a case insensitive substring match
+        self.fts = sqlite3.connect(":memory:", check_same_thread=False)
+        self.fts.execute("create virtual table comments using fts5(comment, tokenize='trigram')")
+        comments = self.reviews.comment.dropna()
+        self.fts.executemany("insert into comments (rowid, comment) values (?, ?)", zip(comments.index.tolist(), comments))
+        self.fts_lock = threading.Lock()
+
+    @staticmethod
+    def sorted_values(values):
+        order = np.argsort(values.to_numpy(), kind="stable")
+        return values.to_numpy()[order], values.index.to_numpy()[order]
+
+    def user(self, users):
+        return np.unique(np.concatenate([self.users.get(user, []) for user in users]).astype(int))
+
+    def ride_time(self, start=None, end=None):
+        lo = 0 if start is None else np.searchsorted(self.ride_times, start.value, side="left")
+        hi = len(self.ride_times) if end is None else np.searchsorted(self.ride_times, end.value, side="right")
+        return np.sort(self.by_ride_time[lo:hi])
+
+    def text(self, text):
+        text = text.lower()
+        if len(text) < MIN_INDEXED_TEXT:
+            return np.flatnonzero(self.comments.str.contains(text, regex=False, na=False).to_numpy())
+        phrase = '"' + text.replace('"', '""') + '"'
+        with self.fts_lock:
+            rows = self.fts.execute("select rowid from comments where comments match ?", (phrase,)).fetchall()
+        return np.sort(np.array([row[0] for row in rows], dtype=int))
+
+    def min_distance(self, km):
+        return np.sort(self.by_distance[np.searchsorted(self.distances, km, side="left") :])
+
+    def direction(self, degrees, spread):
+        """Rides within spread degrees of the direction the knob points at, 0 is north and 90 is east."""
+        center = (np.radians(degrees - 90) + np.pi) % (2 * np.pi) - np.pi
+        spread = np.radians(spread)
+        lo, hi = center - spread, center + spread
+        # a cone over the discontinuity of the angles at pi is split in two
+        if lo < -np.pi:
+            ranges = [(lo + 2 * np.pi, np.pi), (-np.pi, hi)]
+        elif hi > np.pi:
+            ranges = [(lo, np.pi), (-np.pi, hi - 2 * np.pi)]
+        else:
+            ranges = [(lo, hi)]
+        slices = [
+            self.by_angle[np.searchsorted(self.angles, lo, side="right") : np.searchsorted(self.angles, hi, side="left")]
+            for lo, hi in ranges
+        ]
+        return np.unique(np.concatenate(slices))
+
+
+_index = ReloadingIndex(REVIEWS_FILE, lambda path: ReviewIndex(pd.read_pickle(path)))
+
+
+def get_review_index():
+    """The index over the reviews file, rebuilt in the background when show.py wrote a new one. None without a reviews file."""
+    return _index.get()
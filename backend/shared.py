@@ -1,9 +1,16 @@
 import logging
 import os
 import secrets
-from flask import Flask
+import threading
+import time
+from flask import Flask, g, has_request_context, request
 from flask_mailman import Mail
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from backend.metrics import metrics, Profiler
+from scripts.helpers import configure_connection
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -25,6 +32,53 @@ else:
 SECRET_KEY_FILE = ".flask_secret_key"
 
 
+class ReloadingIndex:
+    """
+    An index built from a file that a script replaces from time to time, e.g. show.py's spots.pkl.
+    The first request builds it. After the file changed, requests keep getting the current index while a background
+    thread builds one from the new file, which then takes its place.
+    """
+
+    def __init__(self, path, build):
+        self.path = path
+        self.build = build
+        self.index = None
+        self.mtime = None
+        self.lock = threading.Lock()
+        self.building = False
+
+    def get(self):
+        """The current index, None if the file was never there."""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return self.index
+        if self.index is None:
+            with self.lock:
+                if self.index is None:
+                    self.index, self.mtime = self.build(self.path), mtime
+        elif mtime != self.mtime:
+            self.start_rebuild(mtime)
+        return self.index
+
+    def start_rebuild(self, mtime):
+        with self.lock:
+            if self.building:
+                return
+            self.building = True
+        threading.Thread(target=self.rebuild, args=(mtime,), daemon=True).start()
+
+    def rebuild(self, mtime):
+        try:
+            # the mtime is from before reading the file, so a file replaced meanwhile is picked up by the next request
+            index = self.build(self.path)
+            self.index, self.mtime = index, mtime
+        except Exception:
+            logger.exception(f"Rebuilding the index of {self.path} failed")
+        finally:
+            self.building = False
+
+
 def get_or_create_secret_key():
     if os.path.exists(SECRET_KEY_FILE):
         with open(SECRET_KEY_FILE) as file:
@@ -44,6 +98,15 @@ app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DATABASE}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"pool_pre_ping": True}
 app.config["SESSION_COOKIE_SAMESITE"] = "Strict"
+# set when running several server processes, so that they rate limit reviews through the database
+app.config["RATE_LIMIT_SHARED"] = os.getenv("HITCHMAP_RATE_LIMIT_SHARED", "0") == "1"
+# look up countries the local boundaries can't resolve on Nominatim in the background
+app.config["COUNTRY_ENRICHMENT"] = os.getenv("HITCHMAP_COUNTRY_ENRICHMENT", "1") == "1"
+# profile a sample of the requests to these endpoints (e.g. `experience,spots`) into db/profiles
+app.config["PROFILE_ENDPOINTS"] = set(filter(None, os.getenv("HITCHMAP_PROFILE_ENDPOINTS", "").split(",")))
+app.config["PROFILE_SAMPLE_RATE"] = float(os.getenv("HITCHMAP_PROFILE_SAMPLE_RATE", "0.01"))
+# cprofile or pyinstrument
+app.config["PROFILER"] = os.getenv("HITCHMAP_PROFILER", "cprofile")
 
 # Flask-Mailman configuration
 app.config["MAIL_SERVER"] = "mail.smtp2go.com"
@@ -56,3 +119,55 @@ app.config["MAIL_DEFAULT_SENDER"] = ("Hitchmap", "no-reply@hitchmap.com")
 
 db = SQLAlchemy(app)
 mail = Mail(app)
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, _connection_record):
+    configure_connection(dbapi_connection)
+
+
+profiler = Profiler(
+    os.path.join(db_dir, "profiles"), app.config["PROFILE_ENDPOINTS"], app.config["PROFILE_SAMPLE_RATE"], app.config["PROFILER"]
+)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, _cursor, _statement, _parameters, _context, _executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def stop_query_timer(conn, _cursor, _statement, _parameters, _context, _executemany):
+    seconds = time.perf_counter() - conn.info["query_start"].pop()
+    # queries of background threads, e.g. the country enrichment, aren't part of a request
+    if has_request_context() and "db_seconds" in g:
+        g.db_seconds += seconds
+        g.db_queries += 1
+
+
+def get_endpoint():
+    # requests that matched no route are counted together, their paths are unbounded
+    return request.endpoint or "unmatched"
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.db_seconds = 0.0
+    g.db_queries = 0
+    g.profiler = profiler.start(get_endpoint()) if app.config["PROFILE_ENDPOINTS"] else None
+
+
+@app.after_request
+def record_request(response):
+    if "request_start" in g:
+        seconds = time.perf_counter() - g.request_start
+        metrics.observe_request(get_endpoint(), request.method, response.status_code, seconds, g.db_seconds, g.db_queries)
+    return response
+
+
+@app.teardown_request
+def stop_profiler(_exception):
+    # also runs when the request failed, so the profiler is always released
+    if g.get("profiler") is not None:
+        profiler.stop(g.pop("profiler"), get_endpoint())
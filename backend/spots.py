@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pandas as pd
+import shapely
+from scipy.spatial import cKDTree
+
+from backend.shared import ReloadingIndex, db_dir
+
+# written by scripts/show.py from the same places the map is built from
+SPOTS_FILE = os.path.join(db_dir, "spots.pkl")
+
+EARTH_RADIUS_KM = 6371
+
+
+def to_unit_vectors(lat, lon):
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def km_to_chord(km):
+    return 2 * np.sin(np.asarray(km) / (2 * EARTH_RADIUS_KM))
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(np.asarray(chord) / 2, 1))
+
+
+class SpotIndex:
+    """
+    The spots with an STRtree for bounding boxes and a KD-tree over points on the unit sphere for distances,
+    which stay correct near the poles and the antimeridian.
+    """
+
+    def __init__(self, spots):
+        # most reviewed spots first, so truncated results keep the important ones
+        self.spots = spots.sort_values("review_count", ascending=False, kind="stable").reset_index(drop=True)
+        self.rtree = shapely.STRtree(shapely.points(self.spots.lon, self.spots.lat))
+        self.kdtree = cKDTree(to_unit_vectors(self.spots.lat, self.spots.lon))
+
+    def bbox(self, west, south, east, north):
+        # a box over the antimeridian is split in two
+        boxes = [(west, south, east, north)] if west <= east else [(west, south, 180, north), (-180, south, east, north)]
+        indices = np.concatenate([self.rtree.query(shapely.box(*box), predicate="intersects") for box in boxes])
+        return self.spots.iloc[np.sort(indices)]
+
+    def radius(self, lat, lon, km):
+        indices = self.kdtree.query_ball_point(to_unit_vectors(lat, lon)[0], km_to_chord(km))
+        spots = self.spots.iloc[indices].assign(distance=self.distances(lat, lon, indices))
+        return spots.sort_values("distance", kind="stable")
+
+    def nearest(self, lat, lon, k):
+        chords, indices = self.kdtree.query(to_unit_vectors(lat, lon)[0], k=min(k, len(self.spots)))
+        indices = np.atleast_1d(indices)
+        return self.spots.iloc[indices].assign(distance=chord_to_km(np.atleast_1d(chords)))
+
+    def distances(self, lat, lon, indices):
+        chords = np.linalg.norm(self.kdtree.data[indices] - to_unit_vectors(lat, lon), axis=1)
+        return chord_to_km(chords)
+
+
+_index = ReloadingIndex(SPOTS_FILE, lambda path: SpotIndex(pd.read_pickle(path)))
+
+
+def get_spot_index():
+    """The index over the spots file, rebuilt in the background when show.py wrote a new one. None without a spots file."""
+    return _index.get()
@@ -0,0 +1,139 @@
+import contextlib
+import mimetypes
+import os
+import threading
+import time
+
+from flask import redirect, request, send_file
+
+from backend.shared import dist_dir, static_dir
+from scripts.helpers import BUILD_STAMP
+
+# precompressed copies written next to a file, in order of preference
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+# the data files of show.py's split mode have their hash in the name, tiles change with every new spot
+CACHE_CONTROL = [
+    ("data/", "public, max-age=31536000, immutable"),
+    ("tiles/", "public, max-age=60"),
+]
+# everything else may be cached but has to be revalidated, which is a 304 while the ETag matches
+DEFAULT_CACHE_CONTROL = "no-cache"
+# seconds between checks of the build stamp
+STAMP_CHECK_INTERVAL = 1
+
+
+class StaticFile:
+    def __init__(self, path, stat):
+        self.path = path
+        self.etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        # copies older than the file are left over from a previous build
+        self.encodings = {}
+        for encoding, suffix in ENCODINGS:
+            try:
+                if os.stat(path + suffix).st_mtime_ns >= stat.st_mtime_ns:
+                    self.encodings[encoding] = path + suffix
+            except FileNotFoundError:
+                pass
+
+
+class StaticIndex:
+    """
+    The files in static/ and dist/ by URL path, so serving one needs no lookups on disk besides opening it.
+    The scripts touch dist/.build-stamp after writing to dist, which makes the next request rescan both directories.
+    """
+
+    def __init__(self, directories):
+        self.directories = directories
+        self.files = {}
+        self.stamp = None
+        self.checked_at = 0
+        self.scan_lock = threading.Lock()
+
+    def scan(self):
+        files = {}
+        # files in dist take precedence, as in the fallback of serve_static
+        for directory in reversed(self.directories):
+            for root, subdirectories, filenames in os.walk(directory):
+                subdirectories[:] = [d for d in subdirectories if not d.startswith(".")]
+                for filename in filenames:
+                    if filename.startswith("."):
+                        continue
+                    path = os.path.join(root, filename)
+                    # removed while walking
+                    with contextlib.suppress(FileNotFoundError):
+                        files[os.path.relpath(path, directory).replace(os.sep, "/")] = StaticFile(path, os.stat(path))
+        self.files = files
+
+    def refresh(self):
+        """
+        Rescan if the build stamp changed. The first scan happens in the request, later ones in a background thread
+        while requests keep using the previous index.
+        """
+        if time.monotonic() - self.checked_at < STAMP_CHECK_INTERVAL or not self.scan_lock.acquire(blocking=False):
+            return
+        self.checked_at = time.monotonic()
+        try:
+            stamp = os.stat(os.path.join(dist_dir, BUILD_STAMP)).st_mtime_ns
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self.stamp and self.files:
+            self.scan_lock.release()
+        elif not self.files:
+            self.rescan(stamp)
+        else:
+            threading.Thread(target=self.rescan, args=(stamp,), daemon=True).start()
+
+    def rescan(self, stamp):
+        """Scan and release the scan lock, which the caller holds."""
+        try:
+            self.scan()
+            self.stamp = stamp
+        finally:
+            self.scan_lock.release()
+
+    def get(self, path):
+        self.refresh()
+        return self.files.get(path)
+
+
+static_index = StaticIndex([dist_dir, static_dir])
+
+
+def get_cache_control(path):
+    for prefix, cache_control in CACHE_CONTROL:
+        if path.startswith(prefix):
+            return cache_control
+    return DEFAULT_CACHE_CONTROL
+
+
+def send_static(path):
+    """
+    Send a file of the index, compressed if the client accepts a precompressed copy, or None if it isn't in the index.
+    Paths of directories with an index.html send that, after a redirect to the path with a trailing slash.
+    """
+    if path == "" or path.endswith("/"):
+        file = static_index.get(path + "index.html")
+    else:
+        file = static_index.get(path)
+        if file is None and static_index.get(path + "/index.html") is not None:
+            return redirect(request.path + "/", code=301)
+    if file is None:
+        return None
+
+    encoding = next((encoding for encoding in file.encodings if request.accept_encodings.quality(encoding) > 0), None)
+    try:
+        if encoding:
+            response = send_file(
+                file.encodings[encoding], mimetype=file.mimetype, etag=f"{file.etag}-{encoding}", conditional=True
+            )
+            response.headers["Content-Encoding"] = encoding
+        else:
+            response = send_file(file.path, mimetype=file.mimetype, etag=file.etag, conditional=True)
+    except FileNotFoundError:
+        # removed since the last scan, e.g. a pruned data file
+        return None
+    if file.encodings:
+        response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = get_cache_control(path)
+    return response
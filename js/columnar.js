@@ -0,0 +1,53 @@
+// Decoder for the typed columns written by scripts/columnar.py, keep both in sync
+
+const TYPED_ARRAYS = {uint8: Uint8Array, uint16: Uint16Array, int32: Int32Array, float32: Float32Array};
+const NULLS = {uint8: 0xFF, uint16: 0xFFFF, int32: -0x80000000};
+
+function bytes(base64) {
+    return Uint8Array.from(atob(base64), c => c.charCodeAt(0));
+}
+
+function typedArray(base64, dtype) {
+    return new TYPED_ARRAYS[dtype](bytes(base64).buffer);
+}
+
+function decodeColumn(column, length) {
+    switch (column.encoding) {
+        case 'number': {
+            const nullValue = NULLS[column.dtype];
+            return Array.from(typedArray(column.data, column.dtype), v => v === nullValue || Number.isNaN(v) ? null : v / column.scale);
+        }
+        case 'strings':
+            return column.values;
+        case 'dictionary': {
+            const nullValue = NULLS[column.dtype];
+            return Array.from(typedArray(column.data, column.dtype), code => code === nullValue ? null : column.values[code]);
+        }
+        case 'minutes':
+            return Array.from(typedArray(column.data, 'int32'), v => v === NULLS.int32 ? null : v * 60000);
+        case 'id': {
+            const ids = bytes(column.data);
+            return Array.from({length}, (_, i) =>
+                btoa(String.fromCharCode(...ids.subarray(8 * i, 8 * i + 8))).replace(/\+/g, '-').replace(/\//g, '_'));
+        }
+        case 'boolean':
+            return Array.from(typedArray(column.data, 'uint8'), v => v === 1);
+        case 'lists': {
+            const offsets = typedArray(column.offsets, 'int32');
+            const values = typedArray(column.data, 'int32');
+            return Array.from({length}, (_, i) => Array.from(values.subarray(offsets[i], offsets[i + 1])));
+        }
+        case 'index':
+            return Array.from({length}, (_, i) => i);
+    }
+}
+
+export function isColumnar(data) {
+    return !Array.isArray(data);
+}
+
+// Turn typed columns back into the row arrays the rest of the code works with
+export function decodeColumnar(encoded) {
+    const columns = encoded.columns.map(([_name, column]) => decodeColumn(column, encoded.length));
+    return Array.from({length: encoded.length}, (_, i) => columns.map(values => values[i]));
+}
@@ -7,6 +7,12 @@ import {currentUser, firstUserPromise, userMarkerGroup, createUserMarkers} from
 import {pendingGroup, updatePendingMarkers, addPending} from './pending';
 import {renderReviews} from './render-reviews';
 import {maybeAddNetworkButton} from './network-button';
+import {isColumnar, decodeColumnar} from './columnar';
+import {spotTileLayer} from './spot-tiles';
+
+// show.py's columnar mode sends typed columns instead of rows
+if (isColumnar(window.reviewData)) window.reviewData = decodeColumnar(window.reviewData)
+if (isColumnar(window.markerData)) window.markerData = decodeColumnar(window.markerData)
 
 // Register service worker for offline functionality
 if ("serviceWorker" in navigator) {
@@ -86,7 +92,11 @@ let allMarkers = [];
 let allMarkersRenderer = map.getRenderer(map)
 let normalDrawFunction = allMarkersRenderer._redraw
 
-let heatLayer = L.heatLayer(allCoords, {radius: 5, blur: 1, maxZoom: 1, minOpacity: 1, max: 100, gradient: {0: 'black', 0.9: 'black', 1: 'lightgreen'}}).addTo(map)
+// zoomed out, the spots are a heatmap, or the vector tiles of show.py's tiles mode if the page was built with them
+let heatLayer = (window.spotTilesUrl
+    ? spotTileLayer(window.spotTilesUrl, {className: 'spot-tiles-layer'})
+    : L.heatLayer(allCoords, {radius: 5, blur: 1, maxZoom: 1, minOpacity: 1, max: 100, gradient: {0: 'black', 0.9: 'black', 1: 'lightgreen'}})
+).addTo(map)
 
 // Note: neither will be shown when a filter is active
 function showHeatmapOrDefaultPane() {
@@ -0,0 +1,134 @@
+// Decoder and layer for the vector tiles of the spots written by scripts/vectortiles.py, keep both in sync.
+// Only what those tiles contain is decoded: one layer of points with string, double and integer properties.
+
+const MAX_ZOOM = 8;
+const textDecoder = new TextDecoder();
+
+class Reader {
+    constructor(bytes) {
+        this.bytes = bytes;
+        this.pos = 0;
+    }
+
+    varint() {
+        // multiplying instead of shifting, as bitwise operators cut numbers to 32 bits
+        let value = 0, scale = 1, byte;
+        do {
+            byte = this.bytes[this.pos++];
+            value += (byte & 0x7F) * scale;
+            scale *= 128;
+        } while (byte & 0x80);
+        return value;
+    }
+}
+
+function zigzag(value) {
+    return value % 2 ? -(value + 1) / 2 : value / 2;
+}
+
+// [field number, value] pairs of a protobuf message, length delimited values are the bytes of the field
+function* fields(bytes) {
+    const reader = new Reader(bytes);
+    while (reader.pos < bytes.length) {
+        const key = reader.varint();
+        const number = Math.floor(key / 8), wireType = key % 8;
+        if (wireType === 0) {
+            yield [number, reader.varint()];
+        } else if (wireType === 1) {
+            yield [number, new DataView(bytes.buffer, bytes.byteOffset + reader.pos, 8).getFloat64(0, true)];
+            reader.pos += 8;
+        } else if (wireType === 2) {
+            const length = reader.varint();
+            yield [number, bytes.subarray(reader.pos, reader.pos + length)];
+            reader.pos += length;
+        } else {
+            throw new Error(`Unsupported wire type ${wireType}`);
+        }
+    }
+}
+
+function packedVarints(bytes) {
+    const reader = new Reader(bytes);
+    const values = [];
+    while (reader.pos < bytes.length) values.push(reader.varint());
+    return values;
+}
+
+function decodeValue(bytes) {
+    for (const [number, value] of fields(bytes)) {
+        if (number === 1) return textDecoder.decode(value);
+        if (number === 3) return value;
+        if (number === 6) return zigzag(value);
+    }
+    return null;
+}
+
+// the points of a tile as {x, y, properties}, with x and y in [0, 1) from the top left of the tile
+export function decodeTile(buffer) {
+    const points = [];
+    for (const [number, layer] of fields(new Uint8Array(buffer))) {
+        if (number !== 3) continue;
+        const features = [], keys = [], values = [];
+        let extent = 4096;
+        for (const [field, value] of fields(layer)) {
+            if (field === 2) features.push(value);
+            else if (field === 3) keys.push(textDecoder.decode(value));
+            else if (field === 4) values.push(decodeValue(value));
+            else if (field === 5) extent = value;
+        }
+        for (const feature of features) {
+            let tags = [], geometry = [];
+            for (const [field, value] of fields(feature)) {
+                if (field === 2) tags = packedVarints(value);
+                else if (field === 4) geometry = packedVarints(value);
+            }
+            const properties = {};
+            for (let i = 0; i < tags.length; i += 2) properties[keys[tags[i]]] = values[tags[i + 1]];
+            // a single MoveTo command followed by the position
+            points.push({x: zigzag(geometry[1]) / extent, y: zigzag(geometry[2]) / extent, properties});
+        }
+    }
+    return points;
+}
+
+function drawPoints(canvas, points) {
+    const ctx = canvas.getContext('2d');
+    for (const {x, y, properties} of points) {
+        // cells of the aggregated tiles are bigger the more spots they have, tiles at MAX_ZOOM have single spots
+        const radius = Math.min(2 + Math.log2(properties.spot_count || 1), 6);
+        ctx.beginPath();
+        ctx.arc(x * canvas.width, y * canvas.height, radius, 0, 2 * Math.PI);
+        ctx.fillStyle = {1: 'red', 2: 'orange', 3: 'yellow', 4: 'lightgreen', 5: 'lightgreen'}[Math.round(properties.rating)] || 'black';
+        ctx.fill();
+    }
+}
+
+const SpotTileLayer = L.GridLayer.extend({
+    initialize(url, options) {
+        this._url = url;
+        L.GridLayer.prototype.initialize.call(this, {maxNativeZoom: MAX_ZOOM, pane: 'overlayPane', ...options});
+    },
+
+    createTile(coords, done) {
+        const tile = document.createElement('canvas');
+        const size = this.getTileSize();
+        tile.width = size.x;
+        tile.height = size.y;
+        // with worldCopyJump the map shows copies of the world to the sides, which use the same tiles
+        const tiles = 2 ** coords.z;
+        const url = L.Util.template(this._url, {z: coords.z, x: ((coords.x % tiles) + tiles) % tiles, y: coords.y});
+        fetch(url)
+            // tiles without spots aren't written
+            .then(resp => resp.ok ? resp.arrayBuffer() : null)
+            .then(buffer => {
+                if (buffer) drawPoints(tile, decodeTile(buffer));
+                done(null, tile);
+            })
+            .catch(error => done(error, tile));
+        return tile;
+    },
+});
+
+export function spotTileLayer(url, options) {
+    return new SpotTileLayer(url, options);
+}
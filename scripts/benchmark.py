@@ -0,0 +1,373 @@
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+from helpers import EARTH_RADIUS_M, cluster_spots, dist_dir, root_dir, scripts_dir
+
+# Runs the cron scripts on synthetic databases of a given number of reviews and reports their time and memory per stage.
+#
+#   python benchmark.py 10000 100000 [show] [light] [dump] [dashboard] [clustering] [--output report.json] [--compare old.json]
+#
+# Each size gets its own scratch directory that the scripts use as db/ and dist/ (HITCHMAP_DB_DIR, HITCHMAP_DIST_DIR),
+# the stages are the `with stage(...)` blocks of the scripts, see instrument.py.
+# The report is JSON, so reports of different commits can be compared with --compare.
+# `clustering` compares the haversine clustering of the fetch scripts with the euclidean one on degrees they used before,
+# by time and by the pairs of spots within the merge distance that the euclidean one misses or adds.
+
+SCRIPTS = {
+    "show": ["show.py"],
+    "light": ["show.py", "light"],
+    "dump": ["dump.py"],
+    "dashboard": ["dashboard.py"],
+}
+DEFAULT_SIZES = [10_000, 100_000]
+# merge distances in meters of fetch-roads.py and fetch-areas.py
+CLUSTER_DISTANCES = {"road": 100, "area": 800}
+
+LANGUAGES = ["pl", "fr", "en"]
+COUNTRIES = ["DE", "FR", "PL", "ES", "IT", "NL", "CZ", "AT", "RO", "TR", "US", "CA", "MX", "AR", "AU", "NZ", "MA", "IN"]
+WORDS = (
+    "good spot waited minutes got ride truck driver highway gas station ramp sign thumb police rain night "
+    "easy hard fast slow Berlin Paris Warsaw Madrid Prague Vienna Istanbul nice people cars stop city center"
+).split()
+
+
+def generate(path, reviews, seed=0):
+    """
+    Write a database with the tables the cron scripts read, with reviews rows in points and the other tables scaled
+    along. Spots are clustered around cities and a few spots get most of the reviews, like on the real map.
+    """
+    rng = np.random.default_rng(seed)
+    spot_count = max(reviews // 3, 2)
+    user_count = max(reviews // 20, 1)
+
+    city_count = max(spot_count // 100, 1)
+    city_lat, city_lon = rng.uniform(-40, 65, city_count), rng.uniform(-120, 150, city_count)
+    city_country = rng.choice(COUNTRIES, city_count)
+    spot_city = rng.integers(0, city_count, spot_count)
+    spot_lat = np.round(city_lat[spot_city] + rng.normal(0, 0.3, spot_count), 6)
+    spot_lon = np.round(city_lon[spot_city] + rng.normal(0, 0.3, spot_count), 6)
+
+    # the second spot of each duplicate pair is moved right next to the first one
+    pairs = rng.permutation(spot_count)[: 2 * (spot_count // 100)].reshape(-1, 2)
+    spot_lat[pairs[:, 1]] = np.round(spot_lat[pairs[:, 0]] + 0.002, 6)
+    spot_lon[pairs[:, 1]] = spot_lon[pairs[:, 0]]
+
+    weights = 1 / np.arange(1, spot_count + 1) ** 0.8
+    spot = rng.permutation(spot_count)[rng.choice(spot_count, reviews, p=weights / weights.sum())]
+
+    sentences = np.array([" ".join(rng.choice(WORDS, rng.integers(3, 40))) for _ in range(2000)], dtype=object)
+    datetimes = np.datetime64("2025-06-01") - (rng.power(3, reviews) * 17 * 365 * 24 * 3600).astype("timedelta64[s]")
+    has_datetime = rng.random(reviews) < 0.9
+    has_destination = rng.random(reviews) < 0.35
+    has_ride_datetime = rng.random(reviews) < 0.15
+
+    def optional(values, present):
+        return np.where(present, values, None)
+
+    def timestamps(values):
+        return np.char.replace(np.datetime_as_string(values, unit="s"), "T", " ")
+
+    points = pd.DataFrame(
+        {
+            "id": rng.choice(2**62, reviews, replace=False),
+            "rating": rng.choice([1, 2, 3, 4, 5], reviews, p=[0.1, 0.1, 0.2, 0.3, 0.3]),
+            "wait": np.where(rng.random(reviews) < 0.5, np.round(rng.gamma(2, 12, reviews)), np.nan),
+            "comment": optional(sentences[rng.integers(0, len(sentences), reviews)], rng.random(reviews) < 0.6),
+            "nickname": optional(
+                np.char.add("hitchhiker", rng.integers(0, user_count * 3, reviews).astype(str)), rng.random(reviews) < 0.4
+            ),
+            "datetime": optional(timestamps(datetimes), has_datetime),
+            "ip": np.char.add("10.0.", rng.integers(0, 65536, reviews).astype(str)),
+            "reviewed": 1,
+            "banned": (rng.random(reviews) < 0.01).astype(int),
+            "lat": spot_lat[spot],
+            "lon": spot_lon[spot],
+            "dest_lat": np.where(has_destination, np.clip(spot_lat[spot] + rng.normal(0, 2, reviews), -89, 89), np.nan),
+            "dest_lon": np.where(has_destination, spot_lon[spot] + rng.normal(0, 2, reviews), np.nan),
+            "country": city_country[spot_city[spot]],
+            "signal": rng.choice(np.array(["thumb", "sign", "ask", "ask-sign", None], dtype=object), reviews),
+            "ride_datetime": optional(timestamps(datetimes - np.timedelta64(3600, "s")), has_datetime & has_ride_datetime),
+            "user_id": optional(rng.integers(1, user_count + 1, reviews), rng.random(reviews) < 0.2),
+            "from_hitchwiki": (~has_datetime).astype(int),
+            "revised_by": None,
+        }
+    )
+    revised = rng.random(reviews) < 0.02
+    points.loc[revised, "revised_by"] = points.id[revised].astype(str)
+
+    accepted = rng.random(len(pairs)) < 0.8
+    duplicates = pd.DataFrame(
+        {
+            "id": np.arange(len(pairs)),
+            "from_lat": spot_lat[pairs[:, 1]],
+            "from_lon": spot_lon[pairs[:, 1]],
+            "to_lat": spot_lat[pairs[:, 0]],
+            "to_lon": spot_lon[pairs[:, 0]],
+            "reviewed": 1,
+            "accepted": accepted.astype(int),
+            "ip": "",
+        }
+    )
+
+    def boxes(count, size):
+        chosen = rng.choice(spot_count, min(count, spot_count), replace=False)
+        geometries = shapely.box(
+            spot_lon[chosen] - size, spot_lat[chosen] - size, spot_lon[chosen] + size, spot_lat[chosen] + size
+        )
+        return shapely.to_wkt(geometries), shapely.to_wkb(geometries)
+
+    wkt, wkb = boxes(max(spot_count // 40, 1), 0.003)
+    service_areas = pd.DataFrame(
+        {
+            "geom_id": np.arange(len(wkt)),
+            "geometry_wkt": wkt,
+            "geometry_wkb": wkb,
+            "name": [f"Services {i}" for i in range(len(wkt))],
+        }
+    )
+    wkt, wkb = boxes(max(spot_count // 10, 1), 0.01)
+    road_islands = pd.DataFrame({"id": np.arange(len(wkt)), "geometry_wkt": wkt, "geometry_wkb": wkb})
+
+    users = pd.DataFrame(
+        {
+            "id": np.arange(1, user_count + 1),
+            "username": [f"user{i}" for i in range(1, user_count + 1)],
+            "email": [f"user{i}@example.com" for i in range(1, user_count + 1)],
+            "make_public": (rng.random(user_count) < 0.3).astype(int),
+            "gender": None,
+            "year_of_birth": rng.integers(1950, 2005, user_count),
+            "hitchhiking_since": rng.integers(1970, 2025, user_count),
+            "origin_country": rng.choice(COUNTRIES, user_count),
+            "origin_city": None,
+            "hitchwiki_username": None,
+            "trustroots_username": None,
+        }
+    )
+    roles_users = pd.DataFrame({"user_id": [1], "role_id": [1]})
+
+    commented = points.id[points.comment.notna()].to_numpy()
+    translations = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "point_id": ids,
+                    "language": lang,
+                    "translated_comment": sentences[rng.integers(0, len(sentences), len(ids))],
+                    "translation_date": "2025-01-01",
+                    "is_original": (rng.random(len(ids)) < 0.1).astype(int),
+                }
+            )
+            for lang in LANGUAGES
+            for ids in [commented[rng.random(len(commented)) < 0.5]]
+        ]
+    )
+
+    con = sqlite3.connect(path)
+    for name, table in [
+        ("points", points),
+        ("duplicates", duplicates),
+        ("service_areas", service_areas),
+        ("road_islands", road_islands),
+        ("user", users),
+        ("roles_users", roles_users),
+        ("comment_translations", translations),
+    ]:
+        table.to_sql(name, con, index=False, chunksize=100_000)
+    con.commit()
+    con.close()
+
+
+def read_stages(path):
+    """Total time, number of runs and highest peak memory of each stage in a HITCHMAP_STAGES file."""
+    if not os.path.exists(path):
+        return {}
+    records = pd.read_json(path, lines=True)
+    stages = records.groupby("stage", sort=False).agg(
+        seconds=("seconds", "sum"), count=("seconds", "size"), peak_rss_mb=("peak_rss_mb", "max")
+    )
+    return {
+        name: {"seconds": round(row.seconds, 3), "count": int(row["count"]), "peak_rss_mb": round(row.peak_rss_mb, 1)}
+        for name, row in stages.iterrows()
+    }
+
+
+def run(name, work_dir, env):
+    """Run a script like cron does and measure it, the rusage of the child includes its forked workers."""
+    stages_file = os.path.join(work_dir, f"stages-{name}.jsonl")
+    if os.path.exists(stages_file):
+        os.remove(stages_file)
+    env = {**env, "HITCHMAP_STAGES": stages_file}
+
+    command = [sys.executable, *SCRIPTS[name]]
+    with open(os.path.join(work_dir, f"{name}.log"), "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=scripts_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+
+    return {
+        "script": name,
+        "command": SCRIPTS[name],
+        "returncode": os.waitstatus_to_exitcode(status),
+        "seconds": round(seconds, 3),
+        "cpu_seconds": round(usage.ru_utime + usage.ru_stime, 3),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "stages": read_stages(stages_file),
+    }
+
+
+def get_neighbour_pairs(coords, distance, metric):
+    """The pairs of spots within distance meters of each other, as a set of index pairs with the lower index first."""
+    from sklearn.neighbors import NearestNeighbors
+
+    if metric == "haversine":
+        points, radius = np.radians(coords[["lat", "lon"]].to_numpy()), distance / EARTH_RADIUS_M
+    else:
+        points, radius = coords[["lon", "lat"]].to_numpy(), distance / 111_000
+    graph = NearestNeighbors(radius=radius, metric=metric).fit(points).radius_neighbors_graph(points).tocoo()
+    lower = graph.row < graph.col
+    return set(zip(graph.row[lower].tolist(), graph.col[lower].tolist()))
+
+
+def run_clustering(db_path):
+    """Cluster the spots of a database like the fetch scripts do now and did before, in this process."""
+    from sklearn.cluster import DBSCAN
+    from sklearn.metrics import adjusted_rand_score
+
+    con = sqlite3.connect(db_path)
+    coords = pd.read_sql("select distinct lon, lat from points where not banned and revised_by is null", con)
+    con.close()
+
+    result = {"script": "clustering", "command": [], "returncode": 0, "spots": len(coords), "stages": {}, "quality": {}}
+    start = time.perf_counter()
+    for name, distance in CLUSTER_DISTANCES.items():
+        labels = {}
+        for metric in ["euclidean", "haversine"]:
+            stage_start = time.perf_counter()
+            if metric == "euclidean":
+                labels[metric] = DBSCAN(eps=distance / 111_000, min_samples=2, metric="euclidean").fit(coords).labels_
+            else:
+                labels[metric] = cluster_spots(coords, distance)
+            seconds = time.perf_counter() - stage_start
+            result["stages"][f"{name}_{metric}"] = {"seconds": round(seconds, 3), "count": 1, "peak_rss_mb": None}
+
+        pairs = {metric: get_neighbour_pairs(coords, distance, metric) for metric in labels}
+        result["quality"][name] = {
+            "distance_m": distance,
+            **{f"{metric}_clusters": int(labels[metric].max() + 1) for metric in labels},
+            **{f"{metric}_clustered_spots": int((labels[metric] != -1).sum()) for metric in labels},
+            # neighbours further apart than the merge distance east and west of each other aren't found on degrees,
+            # and the few that are added are a degree of latitude being 111 km instead of 111.2 km
+            "neighbour_pairs": len(pairs["haversine"]),
+            "euclidean_missed_pairs": len(pairs["haversine"] - pairs["euclidean"]),
+            "euclidean_added_pairs": len(pairs["euclidean"] - pairs["haversine"]),
+            "adjusted_rand_index": round(adjusted_rand_score(labels["euclidean"], labels["haversine"]), 4),
+        }
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def benchmark(sizes, scripts, keep=False):
+    runs = []
+    for reviews in sizes:
+        work_dir = tempfile.mkdtemp(prefix=f"hitchmap-benchmark-{reviews}-")
+        db, dist = os.path.join(work_dir, "db"), os.path.join(work_dir, "dist")
+        os.makedirs(db)
+        os.makedirs(dist)
+        # the JS bundle isn't part of the benchmark, show.py skips building it if it is up to date
+        for filename in ["out.js", "out.js.sha256"]:
+            if os.path.exists(os.path.join(dist_dir, filename)):
+                shutil.copy(os.path.join(dist_dir, filename), dist)
+
+        start = time.perf_counter()
+        generate(os.path.join(db, "prod-points.sqlite"), reviews)
+        env = {**os.environ, "HITCHMAP_DB_DIR": db, "HITCHMAP_DIST_DIR": dist}
+        subprocess.run([sys.executable, "migrate.py"], cwd=scripts_dir, env=env, check=True, capture_output=True)
+        print(f"{reviews} reviews: generated in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+        for name in scripts:
+            if name == "clustering":
+                result = {"reviews": reviews, **run_clustering(os.path.join(db, "prod-points.sqlite"))}
+                print(f"{reviews} reviews: clustering took {result['seconds']}s", file=sys.stderr)
+                for quality in result["quality"].values():
+                    print(f"  {quality}", file=sys.stderr)
+                runs.append(result)
+                continue
+            result = {"reviews": reviews, **run(name, work_dir, env)}
+            print(f"{reviews} reviews: {name} took {result['seconds']}s, peak {result['peak_rss_mb']} MB", file=sys.stderr)
+            if result["returncode"]:
+                print(f"{name} failed, see {work_dir}/{name}.log", file=sys.stderr)
+            runs.append(result)
+
+        if keep:
+            print(f"Kept {work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir)
+    return runs
+
+
+def compare(report, previous):
+    """Print the time of each script and stage relative to a previous report."""
+    old = {(run["reviews"], run["script"]): run for run in previous["runs"]}
+    print(f"{'reviews':>10} {'script':<10} {'stage':<20} {'before':>9} {'after':>9} {'ratio':>6}")
+    for run in report["runs"]:
+        before = old.get((run["reviews"], run["script"]))
+        if before is None:
+            continue
+        rows = [("total", before["seconds"], run["seconds"])]
+        rows += [
+            (stage, before["stages"][stage]["seconds"], timing["seconds"])
+            for stage, timing in run["stages"].items()
+            if stage in before["stages"]
+        ]
+        for stage, old_seconds, new_seconds in rows:
+            ratio = new_seconds / old_seconds if old_seconds else float("nan")
+            print(f"{run['reviews']:>10} {run['script']:<10} {stage:<20} {old_seconds:>9.3f} {new_seconds:>9.3f} {ratio:>6.2f}")
+
+
+def get_commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=root_dir, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=root_dir, capture_output=True, text=True
+        ).stdout
+        return commit + ("-dirty" if dirty.strip() else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    output = args[args.index("--output") + 1] if "--output" in args else "benchmark.json"
+    previous = args[args.index("--compare") + 1] if "--compare" in args else None
+    sizes = [int(arg) for arg in args if arg.isdigit()] or DEFAULT_SIZES
+    scripts = [arg for arg in args if arg in SCRIPTS or arg == "clustering"] or ["show", "dump", "dashboard"]
+
+    report = {
+        "commit": get_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "runs": benchmark(sizes, scripts, keep="--keep" in args),
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}", file=sys.stderr)
+
+    if previous:
+        with open(previous) as f:
+            compare(report, json.load(f))
@@ -1,12 +1,13 @@
 import html
 import os
-import sqlite3
 from string import Template
 from datetime import datetime, timedelta
 
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+from helpers import get_db, dist_dir, touch_build_stamp
+from instrument import retention_start, start_job
 
 # see
 # https://realpython.com/python-dash/
@@ -15,8 +16,6 @@ import plotly.graph_objects as go
 
 root_dir = os.path.join(os.path.dirname(__file__), "..")
 
-db_dir = os.path.abspath(os.path.join(root_dir, "db"))
-dist_dir = os.path.abspath(os.path.join(root_dir, "dist"))
 template_dir = os.path.abspath(os.path.join(root_dir, "templates"))
 
 os.makedirs(dist_dir, exist_ok=True)
@@ -27,16 +26,12 @@ with open(template_path, encoding="utf-8") as f:
 
 outname = os.path.join(dist_dir, "dashboard.html")
 
-# TODO: Use dotenv?
-if os.path.exists(os.path.join(db_dir, "prod-points.sqlite")):
-    DATABASE = os.path.join(db_dir, "prod-points.sqlite")
-else:
-    DATABASE = os.path.join(db_dir, "points.sqlite")
+start_job()
 
 # Spots
 df = pd.read_sql(
     "select * from points where not banned and revised_by is null and datetime is not null",
-    sqlite3.connect(DATABASE),
+    get_db(),
 )
 
 df["datetime"] = df["datetime"].astype("datetime64[ns]")
@@ -112,6 +107,37 @@ fig.update_layout(yaxis_title="# of entries")
 timeline_plot = fig.to_html("dash.html", full_html=False)
 
 
+### Cron jobs ###
+# durations of the scripts as recorded by instrument.py, one line per script and mode
+try:
+    job_runs = pd.read_sql(
+        "select job, started_at, seconds, cpu_seconds, peak_rss_mb, status from job_runs"
+        + " where stage is null and started_at > ? order by started_at",
+        get_db(),
+        params=(retention_start(),),
+    )
+except pd.errors.DatabaseError:
+    job_runs = pd.DataFrame(columns=["job", "started_at", "seconds", "cpu_seconds", "peak_rss_mb", "status"])
+
+if len(job_runs):
+    job_runs["started_at"] = pd.to_datetime(job_runs["started_at"])
+    fig = px.line(
+        job_runs,
+        x="started_at",
+        y="seconds",
+        color="job",
+        markers=True,
+        log_y=True,
+        hover_data=["cpu_seconds", "peak_rss_mb", "status"],
+        title="Cron job durations",
+    )
+    fig.update_layout(xaxis_title=None, yaxis_title="seconds")
+    # the plotly script is already part of the timeline
+    job_runs_plot = fig.to_html(full_html=False, include_plotlyjs=False)
+else:
+    job_runs_plot = "No job runs recorded yet"
+
+
 # TODO: necessary to track user progress, move elsewhere later
 ### Show accounts ###
 def e(s):
@@ -120,10 +146,10 @@ def e(s):
 
 points = pd.read_sql(
     sql="select * from points where not banned and revised_by is null order by datetime is not null desc, datetime desc",
-    con=sqlite3.connect(DATABASE),
+    con=get_db(),
 )
 points["user_id"] = points["user_id"].astype(pd.Int64Dtype())
-users = pd.read_sql("select * from user", sqlite3.connect(DATABASE))
+users = pd.read_sql("select * from user", get_db())
 points["username"] = pd.merge(
     left=points[["user_id"]], right=users[["id", "username"]], left_on="user_id", right_on="id", how="left"
 )["username"]
@@ -154,8 +180,11 @@ output = Template(template).substitute(
     {
         "timeline": timeline_plot,
         "user_accounts": user_accounts,
+        "job_runs": job_runs_plot,
     }
 )
 
 with open(outname, "w", encoding="utf-8") as f:
     f.write(output)
+
+touch_build_stamp()
@@ -1,31 +1,75 @@
+import csv
+import io
 import os
 import sqlite3
+import string
+import subprocess
+import sys
+import time
 import zipfile
-from io import BytesIO
+
+import numpy as np
 import pandas as pd
-import random, string
-import subprocess
+from helpers import get_db, db_dir, dist_dir, touch_build_stamp
+from instrument import start_job, stage
 
-root_dir = os.path.join(os.path.dirname(__file__), "..")
-db_dir = os.path.abspath(os.path.join(root_dir, "db"))
-dist_dir = os.path.abspath(os.path.join(root_dir, "dist"))
+# The public subset of the database is copied table by table with INSERT ... SELECT into an attached dump database,
+# and the CSV files are streamed from there into the zip, so no table is ever held in memory as a whole.
+# `python dump.py parquet` also writes the tables as Parquet files to dist/parquet, which needs pyarrow.
 
 os.makedirs(dist_dir, exist_ok=True)
 
 DATABASE = os.path.join(db_dir, "prod-points.sqlite")
 DATABASE_DUMP = os.path.join(dist_dir, "dump.sqlite")
+CSV_DUMP = os.path.join(dist_dir, "csv-dump.zip")
+PARQUET_DIR = os.path.join(dist_dir, "parquet")
+
+PARQUET = "parquet" in sys.argv
 
-if os.path.exists(DATABASE_DUMP):
-    os.remove(DATABASE_DUMP)
+# rows read at a time
+CHUNK_SIZE = 10_000
 
+# tables in the dump with the rows that are public and the columns that are blanked
+TABLES = {
+    "points": ("not banned and revised_by is null", {"ip": "''"}),
+    "duplicates": ("reviewed = accepted", {"ip": "''"}),
+    "service_areas": ("true", {}),
+    "road_islands": ("true", {}),
+    "roles_users": ("true", {}),
+}
+
+# tables in the zip and parquet files, the geometries are in the CSV files as WKT only
+EXPORTS = {
+    "road_islands": ["geometry_wkb"],
+    "service_areas": ["geometry_wkb"],
+    "points": [],
+    "duplicates": [],
+    "user": [],
+}
 
-def copy_table_schema(table_name):
+# user columns that are kept, the others are replaced with random values
+USER_KEPT_COLUMNS = ["id", "make_public"]
+# if consent is given, show personal user information that is equivalent to the account page
+USER_PUBLIC_COLUMNS = [
+    "username",
+    "gender",
+    "year_of_birth",
+    "hitchhiking_since",
+    "origin_country",
+    "origin_city",
+    "hitchwiki_username",
+    "trustroots_username",
+]
+RANDOM_STRING_LENGTH = 10
+ALPHABET = np.frombuffer((string.ascii_letters + string.digits).encode(), dtype=np.uint8)
+
+
+def copy_table_schema(table_name, dest_db):
     """
     Copy table schema using sqlite3 CLI .schema command
     """
 
     source_db = DATABASE
-    dest_db = DATABASE_DUMP
 
     # Get schema using sqlite3 CLI
     result = subprocess.run(["sqlite3", source_db, f".schema {table_name}"], capture_output=True, text=True)
@@ -49,104 +93,154 @@ def copy_table_schema(table_name):
         conn.close()
 
 
-if not os.path.exists(DATABASE):
-    print(f"DB not found: {DATABASE}")
-    exit()
+def quote(name):
+    return f'"{name}"'
+
+
+def get_columns(con, table, database="main"):
+    """Names and declared types of the columns of a table."""
+    return [(row[1], row[2].upper()) for row in con.execute(f'pragma {database}.table_info("{table}")')]
+
+
+def copy_rows(con, table, where, blanked):
+    select = ", ".join(blanked.get(name, quote(name)) for name, _type in get_columns(con, table))
+    with con:
+        return con.execute(f"insert into dump.{quote(table)} select {select} from main.{quote(table)} where {where}").rowcount
+
+
+def random_strings(rng, count):
+    characters = ALPHABET[rng.integers(0, len(ALPHABET), (count, RANDOM_STRING_LENGTH))]
+    return characters.view(f"S{RANDOM_STRING_LENGTH}").ravel().astype(str)
 
-copy_table_schema("points")
-all_points = pd.read_sql("select * from points where not banned and revised_by is null", sqlite3.connect(DATABASE))
-all_points["ip"] = ""
-all_points.to_sql("points", sqlite3.connect(DATABASE_DUMP), index=False, if_exists="append")
-
-
-copy_table_schema("duplicates")
-duplicates = pd.read_sql("select * from duplicates where reviewed = accepted", sqlite3.connect(DATABASE))
-duplicates["ip"] = ""
-duplicates.to_sql("duplicates", sqlite3.connect(DATABASE_DUMP), index=False, if_exists="append")
-
-copy_table_schema("service_areas")
-service_areas = pd.read_sql("select * from service_areas", sqlite3.connect(DATABASE))
-service_areas.to_sql("service_areas", sqlite3.connect(DATABASE_DUMP), index=False, if_exists="append")
-
-copy_table_schema("road_islands")
-road_islands = pd.read_sql("select * from road_islands", sqlite3.connect(DATABASE))
-road_islands.to_sql("road_islands", sqlite3.connect(DATABASE_DUMP), index=False, if_exists="append")
-
-conn = sqlite3.connect(DATABASE)
-cursor = conn.cursor()
-
-### Dump user table ###
-
-copy_table_schema("user")
-
-user_df = pd.read_sql("select * from user", conn)
-cursor.execute("PRAGMA table_info(user)")
-schema = cursor.fetchall()
-
-def generate_random_string(length=10):
-    return "".join(random.choices(string.ascii_letters + string.digits, k=length))
-
-# Identify columns
-id_col = "id"
-make_public_col = "make_public"
-columns = [col[1] for col in schema]
-
-# Prepare new DataFrame
-new_rows = []
-for _, row in user_df.iterrows():
-    new_row = {}
-    for col_info in schema:
-        col_name = col_info[1]
-        col_type = col_info[2].upper()
-        if col_name == id_col:
-            new_row[col_name] = row[id_col]
-        elif col_name == make_public_col:
-            new_row[col_name] = row[make_public_col]
-        elif col_type in ["INTEGER", "INT"]:
-            new_row[col_name] = random.randint(0, 1000)
+
+def anonymize_users(users, columns, rng):
+    """Random values of the column's type for everything but the id, consent and the public information of consenting users."""
+    public = users.make_public.fillna(0).astype(bool)
+    anonymized = {}
+    for name, col_type in columns:
+        if name in USER_KEPT_COLUMNS:
+            anonymized[name] = users[name]
+            continue
+        if col_type in ["INTEGER", "INT"]:
+            values = rng.integers(0, 1001, len(users))
         elif col_type in ["REAL", "FLOAT", "DOUBLE"]:
-            new_row[col_name] = round(random.uniform(0, 100), 2)
+            values = rng.uniform(0, 100, len(users)).round(2)
         elif col_type in ["BOOLEAN", "BOOL"]:
-            new_row[col_name] = random.choice([0, 1])
+            values = rng.integers(0, 2, len(users))
         else:  # Default to TEXT/VARCHAR
-            new_row[col_name] = generate_random_string()
-    # If consent is given, show personal user information that is equivalent to the account page
-    if row[make_public_col]:
-        for user_info_col in [
-            "username",
-            "gender",
-            "year_of_birth",
-            "hitchhiking_since",
-            "origin_country",
-            "origin_city",
-            "hitchwiki_username",
-            "trustroots_username"
-        ]:
-            new_row[user_info_col] = row[user_info_col]
-    new_rows.append(pd.Series(new_row))
-
-users_df = pd.DataFrame(new_rows, columns=columns)
-users_df.to_sql("user", sqlite3.connect(DATABASE_DUMP), index=False, if_exists="append")
-
-###  User table dump - end ###
-
-copy_table_schema("roles_users")
-roles_users = pd.read_sql("select * from roles_users", sqlite3.connect(DATABASE))
-roles_users.to_sql("roles_users", sqlite3.connect(DATABASE_DUMP), index=False, if_exists="append")
-
-# Dictionary of DataFrames with filenames
-dfs = {
-    "road_islands.csv": road_islands,
-    "service_areas.csv": service_areas,
-    "points.csv": all_points,
-    "duplicates.csv": duplicates,
-    "user.csv": users_df
-}
+            values = random_strings(rng, len(users))
+        values = pd.Series(values, index=users.index, dtype=object)
+        anonymized[name] = users[name].astype(object).where(public, values) if name in USER_PUBLIC_COLUMNS else values
+    return pd.DataFrame(anonymized)
+
+
+def copy_users(con, rng):
+    columns = get_columns(con, "user")
+    insert = f'insert into dump."user" values ({", ".join("?" * len(columns))})'
+    count = 0
+    with con:
+        for users in pd.read_sql('select * from main."user"', con, chunksize=CHUNK_SIZE):
+            users = anonymize_users(users, columns, rng)
+            # tolist() turns the numpy values into python ones, which sqlite can bind
+            con.executemany(insert, zip(*(users[name].tolist() for name, _type in columns)))
+            count += len(users)
+    return count
+
+
+def select_dumped(con, table, excluded=()):
+    """The columns of a table in the dump and a cursor over its rows."""
+    columns = [(name, col_type) for name, col_type in get_columns(con, table, "dump") if name not in excluded]
+    return columns, con.execute(f"select {', '.join(quote(name) for name, _type in columns)} from dump.{quote(table)}")
+
+
+def write_csv_zip(con, path):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for table in EXPORTS:
+            columns, cursor = select_dumped(con, table, EXPORTS[table])
+            info = zipfile.ZipInfo(f"{table}.csv", date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with zipf.open(info, "w") as f, io.TextIOWrapper(f, encoding="utf-8", newline="") as text:
+                writer = csv.writer(text, lineterminator="\n")
+                writer.writerow([name for name, _type in columns])
+                while rows := cursor.fetchmany(CHUNK_SIZE):
+                    writer.writerows(rows)
+
+
+def get_arrow_type(pa, col_type):
+    """The arrow type of a declared column type, following sqlite's rules for column affinity."""
+    if "INT" in col_type:
+        return pa.int64()
+    if "BOOL" in col_type:
+        return pa.bool_()
+    if any(name in col_type for name in ["REAL", "FLOA", "DOUB"]):
+        return pa.float64()
+    if "BLOB" in col_type:
+        return pa.binary()
+    return pa.string()
+
+
+def write_parquet(con, directory):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("pyarrow isn't installed, skipping the Parquet files")
+        return
+
+    os.makedirs(directory, exist_ok=True)
+    for table in EXPORTS:
+        # the geometries are kept as WKB, which Parquet stores as is
+        columns, cursor = select_dumped(con, table)
+        schema = pa.schema([(name, get_arrow_type(pa, col_type)) for name, col_type in columns])
+        path = os.path.join(directory, f"{table}.parquet")
+        with pq.ParquetWriter(path + ".tmp", schema) as writer:
+            while rows := cursor.fetchmany(CHUNK_SIZE):
+                arrays = []
+                for field, values in zip(schema, zip(*rows)):
+                    # sqlite stores booleans as 0 and 1 and columns of other types may hold numbers
+                    if field.type in [pa.string(), pa.bool_()]:
+                        cast = str if field.type == pa.string() else bool
+                        values = [None if value is None else cast(value) for value in values]
+                    arrays.append(pa.array(values, type=field.type))
+                writer.write_batch(pa.record_batch(arrays, schema=schema))
+        os.replace(path + ".tmp", path)
+
+
+if not os.path.exists(DATABASE):
+    print(f"DB not found: {DATABASE}")
+    exit()
+
+start_job()
+
+# the previous dump stays available until the new one is complete
+dump_path = DATABASE_DUMP + ".tmp"
+if os.path.exists(dump_path):
+    os.remove(dump_path)
+for table in [*TABLES, "user"]:
+    copy_table_schema(table, dump_path)
+
+con = get_db()
+# the tables are read once from start to end, mapping the database would only make the pages count as memory of this process
+con.execute("pragma mmap_size = 0")
+con.execute("attach database ? as dump", (dump_path,))
+
+for table, (where, blanked) in TABLES.items():
+    with stage("points" if table == "points" else "other_tables") as table_stage:
+        table_stage.rows = copy_rows(con, table, where, blanked)
+
+with stage("users") as users_stage:
+    users_stage.rows = copy_users(con, np.random.default_rng())
+
+with stage("zip"):
+    write_csv_zip(con, CSV_DUMP + ".tmp")
+
+if PARQUET:
+    with stage("parquet"):
+        write_parquet(con, PARQUET_DIR)
+
+con.execute("detach database dump")
+con.close()
+os.replace(dump_path, DATABASE_DUMP)
+os.replace(CSV_DUMP + ".tmp", CSV_DUMP)
 
-# Writing to a ZIP file
-zip_filename = os.path.join(dist_dir, "csv-dump.zip")
-with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-    for file_name, df in dfs.items():
-        with BytesIO() as buff:
-            df.to_csv(buff, index=False)
-            zipf.writestr(file_name, buff.getvalue())
+touch_build_stamp()
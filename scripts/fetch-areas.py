@@ -1,39 +1,59 @@
-import requests_cache
-import requests
+import json
+
 import pandas as pd
 from shapely.geometry import Polygon
 import shapely
-import os
-import time
-from helpers import get_db, scripts_dir
-from sklearn.cluster import DBSCAN
-
-cache_file = os.path.join(scripts_dir, "overpass_api_cache")
-requests_cache.install_cache(cache_file, backend="sqlite", expire_after=6 * 365 * 24 * 60 * 60)
-
-points = pd.read_sql("select * from points where not banned and revised_by is null", get_db())
-
-# Load coordinates (Assuming 'points' DataFrame exists with "lon" and "lat")
-coords = points[["lon", "lat"]].drop_duplicates().reset_index(drop=True)
+import sys
+from helpers import (
+    cluster_spots,
+    get_cluster_fingerprints,
+    get_db,
+    get_stored_fingerprints,
+    load_cluster_results,
+    mark_table_changed,
+)
+from instrument import start_job, stage
+from overpass import Overpass, get_geohash_cell
+from overpass_cache import open_cache
+
+# `python fetch-areas.py batch` fetches the service areas in a geohash cell with one query and finds the ones each spot
+# is in locally, instead of one is_in query per spot
+BATCH = "batch" in sys.argv
+AREA_TILE_PRECISION = 5
+
+start_job()
+
+with stage("load") as load:
+    points = pd.read_sql("select * from points where not banned and revised_by is null", get_db())
+
+    # Load coordinates (Assuming 'points' DataFrame exists with "lon" and "lat")
+    coords = points[["lon", "lat"]].drop_duplicates().reset_index(drop=True)
+    load.rows = len(coords)
 
 # Candidate clustering with DBSCAN
 # This clustering is purely spatial, not OSM aware at all
-AREA_MERGE_DISTANCE = 800
-AREA_MERGE_DISTANCE_DEG = AREA_MERGE_DISTANCE / 111_000  # 111km per degree
+AREA_MERGE_DISTANCE = 800  # meters
 min_samples = 2  # Minimum points to form a cluster
-dbscan = DBSCAN(eps=AREA_MERGE_DISTANCE_DEG, min_samples=min_samples, metric="euclidean").fit(coords)
+# part of the cluster fingerprints, increment it when the query or the service areas derived from it change
+SERVICE_AREAS_VERSION = 1
+with stage("cluster") as cluster:
+    coords["cluster"] = cluster_spots(coords, AREA_MERGE_DISTANCE, min_samples)
 
-coords["cluster"] = dbscan.labels_
+    print(sum(coords["cluster"] != -1), len(coords))
 
-print(sum(coords["cluster"] != -1), len(coords))
+    # Filter out the loners
+    clusters = coords[coords["cluster"] != -1]
+    fingerprints = get_cluster_fingerprints(clusters, SERVICE_AREAS_VERSION)
+    cluster.rows = len(clusters)
 
-# Filter out the loners
-clusters = coords[coords["cluster"] != -1]
+# the service areas of clusters whose spots didn't change since the last run are carried over
+with stage("carry_over") as carry_over:
+    carried = load_cluster_results(get_db(), "service_area_clusters", fingerprints.values())
+    carry_over.rows = len(carried)
 
 
-def get_service_area(lat, lon):
-    overpass_url = "http://overpass-api.de/api/interpreter"
-    overpass_query = f"""
+def service_area_query(lat, lon):
+    return f"""
     [out:json];
     is_in({lat}, {lon})->.a;
     (
@@ -46,18 +66,38 @@ def get_service_area(lat, lon):
     wr(pivot);
     out geom;
     """
-    # Query Overpass API
-    data = None
-    while data is None:
-        try:
-            response = requests.get(overpass_url, params={"data": overpass_query})
-            if not response.from_cache:
-                print("getting service area", lat, lon)
-                time.sleep(1)
-            data = response.json()
-        except Exception as e:
-            print(e)
-            pass
+
+
+def service_area_tile_query(south, west, north, east):
+    bbox = f"{south},{west},{north},{east}"
+    return f"""
+    [out:json];
+    (
+        wr["amenity"="fuel"]({bbox});
+        wr["highway"="service_area"]({bbox});
+        wr["highway"="rest_area"]({bbox});
+        wr["highway"="parking"]({bbox});
+        wr["highway"="services"]({bbox});
+    );
+    out geom;
+    """
+
+
+def get_area_polygons(element):
+    """The polygons of a closed way or a relation's outer ways, like the area Overpass derives from it for is_in."""
+    if "members" in element:
+        lines = [
+            [(node["lon"], node["lat"]) for node in member["geometry"]]
+            for member in element["members"]
+            if member.get("role", "outer") == "outer" and "geometry" in member
+        ]
+        return list(shapely.polygonize([shapely.LineString(line) for line in lines if len(line) >= 2]).geoms)
+    line = [(node["lon"], node["lat"]) for node in element.get("geometry", [])]
+    return [Polygon(line)] if len(line) >= 4 and line[0] == line[-1] else []
+
+
+def get_service_area(data):
+    """The largest fuel station, parking or service area in an is_in response, None if there is none."""
     max_size = -1
     largest_geom_name = largest_geom = largest_geom_id = None
 
@@ -77,7 +117,7 @@ def get_service_area(lat, lon):
         elif "members" in element:
             size = 0
             for member in element["members"]:
-                coords = [(node["lon"], node["lat"]) for node in member["geometry"]]
+                coords = [(node["lon"], node["lat"]) for node in member.get("geometry", [])]
                 if len(coords) < 3:
                     continue
                 polygon = Polygon(coords)
@@ -96,16 +136,104 @@ def get_service_area(lat, lon):
                 else tags.get("name")
             )
 
-    if largest_geom:
-        print("SERVICE", largest_geom_id)
+    if largest_geom is None:
+        return None
+    print("SERVICE", largest_geom_id)
     return largest_geom_id, largest_geom, largest_geom_name
 
 
-areas = []
-for lon, lat, _cluster in clusters.values:
-    geom_id, geom, name = get_service_area(lat, lon)
-    if geom is not None:
-        areas.append((geom_id, shapely.convex_hull(geom).wkt, name))
-
-areas_df = pd.DataFrame(areas, columns=["geom_id", "geometry_wkt", "name"]).drop_duplicates("geometry_wkt")
-areas_df.to_sql("service_areas", get_db(), if_exists="replace", index=False)
+with stage("fetch") as fetch:
+    locations = {
+        i: (lat, lon)
+        for i, (lon, lat, cluster_id) in enumerate(clusters.itertuples(index=False, name=None))
+        if fingerprints[cluster_id] not in carried.index
+    }
+    print(f"{len(locations)} spots in new or changed clusters, {len(carried)} clusters unchanged")
+    areas_by_location = {}
+
+    # the spots of each tile by the tile's geohash, as keys of the queries next to the spots of the single queries
+    tiles = {}
+    queries = {}
+    for i, (lat, lon) in locations.items():
+        if BATCH:
+            cell, bounds = get_geohash_cell(lat, lon, AREA_TILE_PRECISION)
+            tiles.setdefault(cell, []).append(i)
+            queries[cell] = service_area_tile_query(*bounds)
+        else:
+            queries[i] = service_area_query(lat, lon)
+    if BATCH:
+        print(f"{len(tiles)} tiles for {len(locations)} spots")
+
+    def add_area(i, data):
+        area = get_service_area(data)
+        if area is not None:
+            geom_id, geom, name = area
+            areas_by_location[i] = (geom_id, shapely.convex_hull(geom), name)
+
+    def handle(key, data):
+        if key not in tiles:
+            add_area(key, data)
+            return
+        elements = data.get("elements", [])
+        polygons = [
+            (element_index, polygon) for element_index, element in enumerate(elements) for polygon in get_area_polygons(element)
+        ]
+        tree = shapely.STRtree([polygon for _element_index, polygon in polygons])
+        for i in tiles[key]:
+            lat, lon = locations[i]
+            # the elements the spot is in, which is what is_in returns for it
+            containing = sorted({polygons[j][0] for j in tree.query(shapely.Point(lon, lat), predicate="within")})
+            add_area(i, {"elements": [elements[element_index] for element_index in containing]})
+
+    overpass = Overpass(open_cache(), "service_areas")
+    failed = overpass.run(queries, handle)
+    failed = [i for key in failed for i in tiles.get(key, [key])]
+    fetch.rows = len(locations)
+
+if failed:
+    print(f"{len(failed)} spots failed, their clusters are fetched again in the next run")
+elif set(fingerprints.values()) == get_stored_fingerprints(get_db(), "service_area_clusters"):
+    # the areas of a cluster are stored by its fingerprint, so the same fingerprints are the same rows.
+    # not rewriting keeps the version of service_areas, so show.py keeps the spatial assignment of the points
+    print("No service areas changed since the last run")
+    sys.exit()
+
+with stage("write") as write:
+    # the service areas found for the spots of each new or changed cluster, in the order of the spots
+    new_areas = {}
+    for i, cluster_id in enumerate(clusters.cluster):
+        if i in areas_by_location:
+            new_areas.setdefault(cluster_id, []).append(areas_by_location[i])
+    failed_clusters = set(clusters.cluster.iloc[failed])
+
+    area_clusters = []
+    areas = []
+    for cluster_id, fingerprint in sorted(fingerprints.items()):
+        if fingerprint in carried.index:
+            row = carried.loc[fingerprint]
+            hulls = shapely.from_wkb(row.geometry_wkb).geoms
+            cluster = [(geom_id, hull, name) for (geom_id, name), hull in zip(json.loads(row.areas), hulls)]
+        else:
+            cluster = new_areas.get(cluster_id, [])
+        # a cluster with failed spots isn't stored, so the next run fetches it again
+        if cluster_id not in failed_clusters:
+            area_clusters.append(
+                (
+                    fingerprint,
+                    json.dumps([[geom_id, name] for geom_id, _hull, name in cluster]),
+                    shapely.GeometryCollection([hull for _geom_id, hull, _name in cluster]).wkb,
+                )
+            )
+        areas += cluster
+
+    # show.py reads the WKB, the WKT is for humans and the dump
+    areas_df = pd.DataFrame(
+        [(geom_id, hull.wkt, hull.wkb, name) for geom_id, hull, name in areas],
+        columns=["geom_id", "geometry_wkt", "geometry_wkb", "name"],
+    ).drop_duplicates("geometry_wkt")
+    areas_df.to_sql("service_areas", get_db(), if_exists="replace", index=False)
+    mark_table_changed(get_db(), "service_areas")
+    pd.DataFrame(area_clusters, columns=["fingerprint", "areas", "geometry_wkb"]).to_sql(
+        "service_area_clusters", get_db(), if_exists="replace", index=False
+    )
+    write.rows = len(areas_df)
@@ -0,0 +1,38 @@
+import json
+import os
+
+import requests
+import shapely
+from shapely.geometry import mapping, shape
+from helpers import db_dir
+from instrument import start_job, stage
+
+# Natural Earth admin 0 boundaries, the 10m ones are precise enough to tell apart spots close to a border
+BOUNDARIES_URL = "https://raw.githubusercontent.com/nvkelso/natural-earth-vector/master/geojson/ne_10m_admin_0_countries.geojson"
+outname = os.path.join(db_dir, "countries.geojson")
+
+start_job()
+
+with stage("fetch"):
+    response = requests.get(BOUNDARIES_URL, timeout=300)
+    response.raise_for_status()
+
+with stage("parse") as parse:
+    features = []
+    for feature in response.json()["features"]:
+        properties = feature["properties"]
+        # ISO_A2 is -99 for a few countries (e.g. France and Norway) because of their overseas territories
+        country_code = next((code for code in (properties["ISO_A2_EH"], properties["ISO_A2"]) if code != "-99"), None)
+        if country_code is None:
+            print("skipping", properties["NAME"])
+            continue
+        geometry = shapely.make_valid(shape(feature["geometry"]))
+        features.append({"type": "Feature", "properties": {"country_code": country_code}, "geometry": mapping(geometry)})
+    parse.rows = len(features)
+
+print(len(features), "countries")
+
+with stage("write"):
+    with open(outname + ".tmp", "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    os.replace(outname + ".tmp", outname)
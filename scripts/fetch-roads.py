@@ -1,100 +1,191 @@
 import pandas as pd
-import requests_cache
-import requests
 from shapely.geometry import MultiLineString, LineString, Point
 import shapely
-from sklearn.cluster import DBSCAN
-import os
-import time
-
-from helpers import get_db, scripts_dir
-
-cache_file = os.path.join(scripts_dir, "overpass_api_cache")
-requests_cache.install_cache(cache_file, backend="sqlite", expire_after=6 * 365 * 24 * 60 * 60)
-
-points = pd.read_sql("select * from points where not banned and revised_by is null", get_db())
-
-# Load coordinates (Assuming 'points' DataFrame exists with "lon" and "lat")
-coords = points[["lon", "lat"]].drop_duplicates().reset_index(drop=True)
+import sys
+
+from helpers import (
+    cluster_spots,
+    get_cluster_fingerprints,
+    get_db,
+    get_stored_fingerprints,
+    load_cluster_results,
+    mark_table_changed,
+)
+from instrument import start_job, stage
+from overpass import Overpass, get_geohash_cell
+from overpass_cache import open_cache
+
+# `python fetch-roads.py batch` fetches the roads of all clusters in a geohash cell with one query and selects the roads
+# around each cluster locally, instead of one query per cluster
+BATCH = "batch" in sys.argv
+ROAD_TILE_PRECISION = 5
+# a tile's query covers its cell and this margin, clusters near the edge of the cell with a larger search size are fetched alone
+ROAD_TILE_MARGIN_DEG = 1000 / 111_000
+
+start_job()
+
+with stage("load") as load:
+    points = pd.read_sql("select * from points where not banned and revised_by is null", get_db())
+
+    # Load coordinates (Assuming 'points' DataFrame exists with "lon" and "lat")
+    coords = points[["lon", "lat"]].drop_duplicates().reset_index(drop=True)
+    load.rows = len(coords)
 
 # Candidate clustering with DBSCAN
 # This clustering is purely spatial, not OSM aware at all
-ROAD_MERGE_DISTANCE = 100
-ROAD_MERGE_DISTANCE_DEG = ROAD_MERGE_DISTANCE / 111_000  # 111km per degree
+ROAD_MERGE_DISTANCE = 100  # meters
 min_samples = 2  # Minimum points to form a cluster
-dbscan = DBSCAN(eps=ROAD_MERGE_DISTANCE_DEG, min_samples=min_samples, metric="euclidean").fit(coords)
+# part of the cluster fingerprints, increment it when the query or the road islands derived from it change
+ROAD_ISLANDS_VERSION = 1
+with stage("cluster") as cluster:
+    # Assign cluster labels
+    coords["cluster"] = cluster_spots(coords, ROAD_MERGE_DISTANCE, min_samples)
 
-# Assign cluster labels
-coords["cluster"] = dbscan.labels_
+    # Filter out the loners
+    clusters = coords[coords["cluster"] != -1]
+    fingerprints = get_cluster_fingerprints(clusters, ROAD_ISLANDS_VERSION)
+    cluster.rows = len(clusters)
 
-# Filter out the loners
-clusters = coords[coords["cluster"] != -1]
+# the road islands of clusters whose spots didn't change since the last run are carried over
+with stage("carry_over") as carry_over:
+    carried = load_cluster_results(get_db(), "road_networks", fingerprints.values())
+    carry_over.rows = len(carried)
 
 
-# Overpass Query Function
-def fetch_osm_data(lat, lon, search_size):
-    query = f"""
+def road_query(lat, lon, search_size):
+    return f"""
     [out:json];
     way(around:{search_size},{lat},{lon})["highway"~"motorway|trunk|primary|secondary|tertiary|unclassified|residential|service"];
     (._;>;);
     out body geom;
     """
-    url = "http://overpass-api.de/api/interpreter"
-
-    while True:
-        try:
-            response = requests.get(url, params={"data": query})
-            if not response.from_cache:
-                time.sleep(1)
-            print(f"fetching for {lat}, {lon}")
-            return response.json()
-        except Exception as e:
-            print(e)
-
-
-# Process clusters
-road_networks = []
-road_islands = []
-road_island_id = 0
 
-grouped = clusters.groupby("cluster")
-print(len(grouped))
-for _cluster_id, group in grouped:
-    lat, lon = group["lat"].mean(), group["lon"].mean()
-    search_size_deg = 1.2 * (group["lat"].max() - group["lat"].min() + group["lon"].max() - group["lon"].min())
-    search_size = search_size_deg * 111_000
 
-    osm_data = fetch_osm_data(lat, lon, search_size)
-
-    if osm_data and "elements" in osm_data:
-        lines = []
-        for element in osm_data["elements"]:
-            if "geometry" in element:
-                line_coords = [(pt["lon"], pt["lat"]) for pt in element["geometry"]]
-                lines.append(LineString(line_coords))
-
-        multilinestring = MultiLineString(lines)
-        geom_wkt = multilinestring.wkt
-        road_networks.append((lat, lon, search_size_deg, geom_wkt))
-
-        # create perimeter of at least 1 meter
-        perimeter = Point(lon, lat).buffer(max(search_size_deg / 1.1, 1 / 111_000), quad_segs=4)
-
-        roads_in_perimeter = multilinestring.intersection(perimeter)
+def road_tile_query(south, west, north, east):
+    return f"""
+    [out:json];
+    way({south},{west},{north},{east})["highway"~"motorway|trunk|primary|secondary|tertiary|unclassified|residential|service"];
+    out geom;
+    """
 
-        road_network_with_boundary = shapely.unary_union([perimeter.boundary, roads_in_perimeter], grid_size=0.000001)
-        # Each "hole" in the road network is its own road_island
-        road_island_collection = shapely.polygonize([road_network_with_boundary])
 
-        for road_island in road_island_collection.geoms:
-            road_islands.append((road_island_id, road_island.wkt))
-            road_island_id += 1
+def get_roads(osm_data):
+    return [
+        LineString([(pt["lon"], pt["lat"]) for pt in element["geometry"]])
+        for element in osm_data["elements"]
+        if "geometry" in element
+    ]
+
+
+def get_road_islands(lat, lon, search_size_deg, lines):
+    """The road network around a cluster and the polygons the roads split its surroundings into."""
+    multilinestring = MultiLineString(lines)
+    road_network = (lat, lon, search_size_deg, multilinestring.wkt)
+
+    # create perimeter of at least 1 meter
+    perimeter = Point(lon, lat).buffer(max(search_size_deg / 1.1, 1 / 111_000), quad_segs=4)
+
+    roads_in_perimeter = multilinestring.intersection(perimeter)
+
+    road_network_with_boundary = shapely.unary_union([perimeter.boundary, roads_in_perimeter], grid_size=0.000001)
+    # Each "hole" in the road network is its own road_island
+    return road_network, list(shapely.polygonize([road_network_with_boundary]).geoms)
+
+
+with stage("fetch") as fetch:
+    searches = {}
+    for cluster_id, group in clusters.groupby("cluster"):
+        if fingerprints[cluster_id] in carried.index:
+            continue
+        lat, lon = group["lat"].mean(), group["lon"].mean()
+        search_size_deg = 1.2 * (group["lat"].max() - group["lat"].min() + group["lon"].max() - group["lon"].min())
+        searches[cluster_id] = (lat, lon, search_size_deg)
+    print(f"{len(searches)} new or changed clusters, {len(carried)} unchanged")
+
+    # the clusters of each tile by the tile's geohash, as keys of the queries next to the cluster ids of the single queries
+    tiles = {}
+    queries = {}
+    for cluster_id, (lat, lon, search_size_deg) in searches.items():
+        if BATCH and search_size_deg <= ROAD_TILE_MARGIN_DEG:
+            cell, (south, west, north, east) = get_geohash_cell(lat, lon, ROAD_TILE_PRECISION)
+            tiles.setdefault(cell, []).append(cluster_id)
+            queries[cell] = road_tile_query(
+                max(south - ROAD_TILE_MARGIN_DEG, -90),
+                west - ROAD_TILE_MARGIN_DEG,
+                min(north + ROAD_TILE_MARGIN_DEG, 90),
+                east + ROAD_TILE_MARGIN_DEG,
+            )
+        else:
+            queries[cluster_id] = road_query(lat, lon, search_size_deg * 111_000)
+    if BATCH:
+        print(f"{len(tiles)} tiles for {sum(map(len, tiles.values()))} clusters, {len(queries) - len(tiles)} clusters alone")
+
+    results = {}
+
+    def handle(key, osm_data):
+        if not osm_data or "elements" not in osm_data:
+            return
+        lines = get_roads(osm_data)
+        if key not in tiles:
+            results[key] = get_road_islands(*searches[key], lines)
+            return
+        tree = shapely.STRtree(lines)
+        for cluster_id in tiles[key]:
+            lat, lon, search_size_deg = searches[cluster_id]
+            # the roads within the search size in degrees, which are fewer than around() finds east and west of the cluster,
+            # but include all that reach into the perimeter the road islands are made in
+            nearby = sorted(tree.query(Point(lon, lat), predicate="dwithin", distance=search_size_deg))
+            results[cluster_id] = get_road_islands(lat, lon, search_size_deg, [lines[i] for i in nearby])
+
+    overpass = Overpass(open_cache(), "roads")
+    failed = overpass.run(queries, handle)
+    fetch.rows = len(searches)
+
+failed_clusters = [cluster_id for key in failed for cluster_id in tiles.get(key, [key])]
+if failed_clusters:
+    # the tables are rewritten as a whole, so writing now would drop the road islands the failed clusters had before.
+    # the responses that did arrive are cached, so the next run only queries the failed ones again
+    print(f"{len(failed_clusters)} clusters failed, keeping the road islands of the last run")
+    sys.exit(1)
+
+# a road network is stored by the fingerprint of its cluster, so the same fingerprints are the same rows
+written = {
+    fingerprint for cluster_id, fingerprint in fingerprints.items() if fingerprint in carried.index or cluster_id in results
+}
+if written == get_stored_fingerprints(get_db(), "road_networks"):
+    # rewriting would renumber the road islands and give them a new version, which makes show.py recompute the
+    # spatial assignment of all points
+    print("No road networks changed since the last run")
+    sys.exit()
 
 
 # Convert to DataFrame
-road_networks_df = pd.DataFrame(road_networks, columns=["lat", "lon", "search_size_deg", "geometry_wkt"])
-road_islands_df = pd.DataFrame(road_islands, columns=["id", "geometry_wkt"]).drop_duplicates("geometry_wkt")
-
-# Store in SQLite Database
-road_networks_df.to_sql("road_networks", get_db(), if_exists="replace", index=False)
-road_islands_df.to_sql("road_islands", get_db(), if_exists="replace", index=False)
+with stage("write") as write:
+    # the road islands of each cluster are kept with its road network, as a collection in the order polygonize made them
+    road_networks = []
+    for cluster_id, fingerprint in sorted(fingerprints.items()):
+        if fingerprint in carried.index:
+            network = carried.loc[fingerprint]
+            road_networks.append(
+                (network.lat, network.lon, network.search_size_deg, network.geometry_wkt, fingerprint, network.road_islands_wkb)
+            )
+        elif cluster_id in results:
+            road_network, islands = results[cluster_id]
+            road_networks.append((*road_network, fingerprint, shapely.GeometryCollection(islands).wkb))
+    road_networks_df = pd.DataFrame(
+        road_networks, columns=["lat", "lon", "search_size_deg", "geometry_wkt", "fingerprint", "road_islands_wkb"]
+    )
+
+    # the ids follow the clusters, so they don't depend on the order the responses came in
+    islands = [island for wkb in road_networks_df.road_islands_wkb for island in shapely.from_wkb(wkb).geoms]
+    # show.py reads the WKB, the WKT is for humans and the dump
+    road_islands_df = pd.DataFrame(
+        [(road_island_id, island.wkt, island.wkb) for road_island_id, island in enumerate(islands)],
+        columns=["id", "geometry_wkt", "geometry_wkb"],
+    ).drop_duplicates("geometry_wkt")
+
+    # Store in SQLite Database
+    road_networks_df.to_sql("road_networks", get_db(), if_exists="replace", index=False)
+    road_islands_df.to_sql("road_islands", get_db(), if_exists="replace", index=False)
+    mark_table_changed(get_db(), "road_islands")
+    write.rows = len(road_islands_df)
@@ -1,24 +1,20 @@
 import os
-import sqlite3
 
 import folium
 import numpy as np
 import pandas as pd
-from helpers import haversine_np
+from helpers import get_db, haversine_np, dist_dir, touch_build_stamp
+from instrument import start_job, stage
 from matplotlib import cm, colors
 
-root_dir = os.path.join(os.path.dirname(__file__), "..")
+start_job()
 
-db_dir = os.path.abspath(os.path.join(root_dir, "db"))
-dist_dir = os.path.abspath(os.path.join(root_dir, "dist"))
-
-DATABASE = os.path.join(db_dir, "prod-points.sqlite")
-
-
-points = pd.read_sql(
-    "select * from points where not banned and revised_by is null order by datetime is not null desc, datetime desc",
-    sqlite3.connect(DATABASE),
-)
+with stage("load") as load:
+    points = pd.read_sql(
+        "select * from points where not banned and revised_by is null order by datetime is not null desc, datetime desc",
+        get_db(),
+    )
+    load.rows = len(points)
 
 
 rads = points[["lon", "lat", "dest_lon", "dest_lat"]].values.T
@@ -79,3 +75,5 @@ if DIVIDER:
     m.save(os.path.abspath(os.path.join(dist_dir, f"heatmap-{VAR}-per-{DIVIDER}.html")))
 else:
     m.save(os.path.abspath(os.path.join(dist_dir, f"heatmap-{VAR}.html")))
+
+touch_build_stamp()
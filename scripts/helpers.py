@@ -1,8 +1,14 @@
+import hashlib
+import json
 import os
 import sqlite3
 import numpy as np
+import pandas as pd
 import unicodedata
 import re
+import uuid
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 
 def haversine_np(lon1, lat1, lon2, lat2, factor=1.25):
@@ -26,6 +32,22 @@ def haversine_np(lon1, lat1, lon2, lat2, factor=1.25):
     return factor * km
 
 
+EARTH_RADIUS_M = 6_371_000
+
+
+def cluster_spots(coords, distance, min_samples=2):
+    """
+    DBSCAN cluster labels of a DataFrame with lon and lat columns, -1 for the spots in no cluster. Spots are neighbours
+    if they are at most distance meters apart along the earth's surface, which a BallTree finds with the haversine metric,
+    so a cluster reaches as far east and west as it does north and south at every latitude.
+    """
+    # only the fetch scripts cluster, the server imports this module too and sklearn is slow to import
+    from sklearn.cluster import DBSCAN
+
+    dbscan = DBSCAN(eps=distance / EARTH_RADIUS_M, min_samples=min_samples, metric="haversine", algorithm="ball_tree")
+    return dbscan.fit(np.radians(coords[["lat", "lon"]].to_numpy(dtype=float))).labels_
+
+
 def get_bearing(lon1, lat1, lon2, lat2):
     dLon = lon2 - lon1
     x = np.cos(np.radians(lat2)) * np.sin(np.radians(dLon))
@@ -38,12 +60,156 @@ def get_bearing(lon1, lat1, lon2, lat2):
     return brng
 
 
-def get_db():
+def get_duplicate_replacements(duplicates):
+    """
+    Map duplicate spots to the spot that represents them, given the from_lat, from_lon, to_lat, to_lon
+    columns of the accepted duplicates. Duplicates that point at each other form islands, an island is
+    represented by its only spot that isn't marked as a duplicate, and is left alone if there are several.
+    Returns a DataFrame of lat, lon, to_lat, to_lon with one row per replaced spot.
+    """
+    coords = np.concatenate([duplicates[["from_lat", "from_lon"]].to_numpy(), duplicates[["to_lat", "to_lon"]].to_numpy()])
+    # spots are numbered by their coordinates, so the graph can be built from integer arrays
+    spots, numbers = np.unique(coords.astype(float), axis=0, return_inverse=True)
+    numbers = numbers.reshape(-1)
+    from_spots, to_spots = numbers[: len(duplicates)], numbers[len(duplicates) :]
+
+    graph = coo_matrix((np.ones(len(duplicates)), (from_spots, to_spots)), shape=(len(spots), len(spots)))
+    island_count, islands = connected_components(graph, directed=False)
+
+    is_representative = np.ones(len(spots), dtype=bool)
+    is_representative[from_spots] = False
+    representative_count = np.bincount(islands, weights=is_representative, minlength=island_count)
+    representative = np.zeros(island_count, dtype=int)
+    representative[islands[is_representative]] = np.flatnonzero(is_representative)
+
+    replaced = ~is_representative & (representative_count[islands] == 1)
+    targets = spots[representative[islands[replaced]]]
+    return pd.DataFrame({"lat": spots[replaced, 0], "lon": spots[replaced, 1], "to_lat": targets[:, 0], "to_lon": targets[:, 1]})
+
+
+def replace_coordinates(points, replacements):
+    """Move the lat, lon of points that are in replacements, see get_duplicate_replacements."""
+    merged = points[["lat", "lon"]].merge(replacements, on=["lat", "lon"], how="left")
+    replace = merged.to_lat.notna().to_numpy()
+    points.loc[replace, "lat"] = merged.to_lat.to_numpy()[replace]
+    points.loc[replace, "lon"] = merged.to_lon.to_numpy()[replace]
+    return points
+
+
+def get_cluster_fingerprints(coords, version):
+    """
+    A fingerprint per cluster of a DataFrame of lon, lat and cluster: the hash of the cluster's sorted coordinates
+    and the version of what is derived from them. It stays the same across runs as long as the cluster's spots do.
+    """
+    coords = coords.sort_values(["cluster", "lon", "lat"])
+    return {
+        cluster: hashlib.sha256(str(version).encode() + group[["lon", "lat"]].to_numpy(dtype=float).tobytes()).hexdigest()[:32]
+        for cluster, group in coords.groupby("cluster", sort=False)
+    }
+
+
+def load_cluster_results(con, table, fingerprints):
+    """
+    The rows of a table of results per cluster whose cluster has one of the fingerprints, indexed by fingerprint.
+    Empty if the table doesn't exist or has no fingerprints yet, so every cluster is computed.
+    """
+    columns = [row[1] for row in con.execute(f"pragma table_info({table})")]
+    if "fingerprint" not in columns:
+        return pd.DataFrame(index=pd.Index([], name="fingerprint"))
+    return pd.read_sql(
+        f"select * from {table} where fingerprint in (select value from json_each(?))",
+        con,
+        params=(json.dumps(list(fingerprints)),),
+    ).set_index("fingerprint")
+
+
+def get_stored_fingerprints(con, table):
+    """The fingerprints of the clusters a table of results per cluster has rows for, empty like load_cluster_results."""
+    columns = [row[1] for row in con.execute(f"pragma table_info({table})")]
+    if "fingerprint" not in columns:
+        return set()
+    return {fingerprint for (fingerprint,) in con.execute(f"select fingerprint from {table}")}
+
+
+def mark_table_changed(con, table):
+    """
+    Give a table a new version after rewriting it with different rows, show.py compares the versions to notice that the geometries changed
+    even if the rewritten table looks the same by its row count and size.
+    """
+    with con:
+        con.execute("create table if not exists table_versions (name text primary key, version text not null)")
+        con.execute("insert or replace into table_versions values (?, ?)", (table, uuid.uuid4().hex))
+
+
+def get_table_versions(con, tables):
+    """The versions of the tables by name, None for tables that were never marked as changed."""
+    if con.execute("select 1 from sqlite_master where type = 'table' and name = 'table_versions'").fetchone() is None:
+        return {table: None for table in tables}
+    versions = dict(con.execute("select name, version from table_versions"))
+    return {table: versions.get(table) for table in tables}
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def find_phrases(texts, phrases):
+    """
+    Find which of the phrases (e.g. city names) each of the texts mentions as whole words, ignoring case, in a single pass.
+    Returns the postings: for each phrase, the positions of the texts mentioning it, in order.
+    """
+    # trie over the words of the phrases, the phrases ending at a node are stored under None
+    trie = {}
+    for i, phrase in enumerate(phrases):
+        node = trie
+        for token in tokenize(phrase):
+            node = node.setdefault(token, {})
+        node.setdefault(None, []).append(i)
+
+    postings = [[] for _ in phrases]
+    for position, text in enumerate(texts):
+        if not isinstance(text, str):
+            continue
+        tokens = tokenize(text)
+        found = set()
+        for start in range(len(tokens)):
+            node = trie
+            for token in tokens[start:]:
+                node = node.get(token)
+                if node is None:
+                    break
+                found.update(node.get(None, ()))
+        for i in found:
+            postings[i].append(position)
+    return postings
+
+
+# applied to every connection to the points database, the server writes while the cron jobs and datasette read
+SQLITE_PRAGMAS = {
+    # readers and the writer don't block each other
+    "journal_mode": "wal",
+    # with wal this only syncs at checkpoints and can't corrupt the database
+    "synchronous": "normal",
+    # wait for the write lock instead of failing with "database is locked"
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+
+def get_database_path():
     if os.path.exists(os.path.join(db_dir, "prod-points.sqlite")):
-        DATABASE = os.path.join(db_dir, "prod-points.sqlite")
-    else:
-        DATABASE = os.path.join(db_dir, "points.sqlite")
-    return sqlite3.connect(DATABASE)
+        return os.path.join(db_dir, "prod-points.sqlite")
+    return os.path.join(db_dir, "points.sqlite")
+
+
+def configure_connection(con):
+    for pragma, value in SQLITE_PRAGMAS.items():
+        con.execute(f"pragma {pragma} = {value}")
+    return con
+
+
+def get_db():
+    return configure_connection(sqlite3.connect(get_database_path()))
 
 
 def slugify(value, allow_unicode=False):
@@ -64,5 +230,14 @@ def slugify(value, allow_unicode=False):
 
 scripts_dir = os.path.dirname(__file__)
 root_dir = os.path.join(scripts_dir, "..")
-db_dir = os.path.abspath(os.path.join(root_dir, "db"))
-dist_dir = os.path.abspath(os.path.join(root_dir, "dist"))
+# benchmark.py points these at a scratch directory
+db_dir = os.path.abspath(os.environ.get("HITCHMAP_DB_DIR", os.path.join(root_dir, "db")))
+dist_dir = os.path.abspath(os.environ.get("HITCHMAP_DIST_DIR", os.path.join(root_dir, "dist")))
+# touched after a script changed files in dist, the server then rescans dist for its static file index
+BUILD_STAMP = ".build-stamp"
+
+
+def touch_build_stamp():
+    path = os.path.join(dist_dir, BUILD_STAMP)
+    with open(path, "a"):
+        os.utime(path)
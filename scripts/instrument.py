@@ -0,0 +1,198 @@
+import atexit
+import contextlib
+import datetime
+import json
+import os
+import re
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+
+from helpers import get_db
+
+# Timing of the cron scripts. A script calls start_job() once and wraps its steps in `with stage(...)`.
+# When it exits, the job and its stages are appended to the job_runs table, which dashboard.py charts,
+# and to a Prometheus textfile if HITCHMAP_PROMETHEUS_DIR is set (the directory of node_exporter's textfile collector).
+
+# benchmark.py sets this to a file that each stage appends a JSON line to
+STAGES_FILE = os.environ.get("HITCHMAP_STAGES")
+PROMETHEUS_DIR = os.environ.get("HITCHMAP_PROMETHEUS_DIR")
+# runs older than this are deleted when a job finishes, it is the window that dashboard.py charts
+RETENTION_DAYS = 90
+
+JOB_RUNS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS job_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    job TEXT NOT NULL,
+    stage TEXT,
+    started_at TEXT NOT NULL,
+    seconds REAL,
+    cpu_seconds REAL,
+    peak_rss_mb REAL,
+    rows INTEGER,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS job_runs_job_started_at ON job_runs(job, started_at);
+CREATE INDEX IF NOT EXISTS job_runs_started_at ON job_runs(started_at);
+"""
+
+_stack = []
+_job = None
+
+
+class Stage:
+    """A running stage, set rows to the number of rows it handled to have it recorded."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.started_at = now()
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+
+    def finish(self):
+        return {
+            "stage": self.name,
+            "started_at": self.started_at,
+            "seconds": time.perf_counter() - self.start,
+            "cpu_seconds": time.process_time() - self.start_cpu,
+            "peak_rss_mb": peak_rss_mb(),
+            "rows": self.rows,
+        }
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def retention_start():
+    """The start of the retention window in the format of started_at."""
+    start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=RETENTION_DAYS)
+    return start.strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far, ru_maxrss is in kilobytes on Linux."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def default_job_name():
+    """The script and its arguments, e.g. `show light`, as the modes of a script are separate jobs."""
+    return " ".join([os.path.basename(sys.argv[0]).removesuffix(".py"), *sys.argv[1:]])
+
+
+def start_job(name=None):
+    """Record this process as a job, which is saved when the process exits."""
+    global _job
+    _job = {"job": name or default_job_name(), "stage": Stage(None), "stages": [], "status": "ok", "pid": os.getpid()}
+
+    excepthook = sys.excepthook
+
+    def record_failure(*args):
+        _job["status"] = "failed"
+        excepthook(*args)
+
+    sys.excepthook = record_failure
+    atexit.register(finish_job)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Time a step of a script. Stages nest, a stage inside another one is recorded as outer/inner.
+    The peak memory is the highest the process got until the end of the stage, so it grows in the stage that needed it.
+    """
+    _stack.append(name)
+    current = Stage("/".join(_stack))
+    try:
+        yield current
+    finally:
+        _stack.pop()
+        record = current.finish()
+        # stages of forked workers can't reach the parent's job, they only go to the stages file
+        if _job is not None and _job["pid"] == os.getpid():
+            _job["stages"].append(record)
+        if STAGES_FILE:
+            with open(STAGES_FILE, "a") as f:
+                f.write(json.dumps({**record, "pid": os.getpid()}) + "\n")
+
+
+def finish_job():
+    if _job["pid"] != os.getpid():
+        return
+    records = [_job["stage"].finish(), *_job["stages"]]
+    run_id = f"{_job['stage'].started_at}-{os.getpid()}"
+    rows = [
+        (
+            run_id,
+            _job["job"],
+            record["stage"],
+            record["started_at"],
+            record["seconds"],
+            record["cpu_seconds"],
+            record["peak_rss_mb"],
+            record["rows"],
+            _job["status"] if record["stage"] is None else None,
+        )
+        for record in records
+    ]
+    try:
+        con = get_db()
+        con.executescript(JOB_RUNS_SCHEMA)
+        with con:
+            con.executemany(
+                """insert into job_runs (run_id, job, stage, started_at, seconds, cpu_seconds, peak_rss_mb, rows, status)
+                values (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                rows,
+            )
+            # also the runs of jobs that don't run anymore, the index on started_at finds them without a scan
+            con.execute("delete from job_runs where started_at < ?", (retention_start(),))
+    except sqlite3.Error as e:
+        print(f"Could not save the job run: {e}")
+
+    if PROMETHEUS_DIR:
+        write_prometheus_textfile(_job["job"], _job["status"], records)
+
+
+def write_prometheus_textfile(job, status, records):
+    """The last run of the job in the Prometheus text format, replaced atomically so the collector never reads half a file."""
+
+    def escape(value):
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def labels(record):
+        return "{" + f'job="{escape(job)}"' + (f',stage="{escape(record["stage"])}"' if record["stage"] else "") + "}"
+
+    # a stage that ran several times is one series
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record["stage"], {**record, "seconds": 0, "cpu_seconds": 0, "rows": None})
+        total["seconds"] += record["seconds"]
+        total["cpu_seconds"] += record["cpu_seconds"]
+        total["peak_rss_mb"] = max(total["peak_rss_mb"], record["peak_rss_mb"])
+        if record["rows"] is not None:
+            total["rows"] = (total["rows"] or 0) + record["rows"]
+    records = list(totals.values())
+
+    lines = []
+    for metric, key, scale in [
+        ("hitchmap_job_duration_seconds", "seconds", 1),
+        ("hitchmap_job_cpu_seconds", "cpu_seconds", 1),
+        ("hitchmap_job_peak_rss_bytes", "peak_rss_mb", 1024 * 1024),
+        ("hitchmap_job_rows", "rows", 1),
+    ]:
+        lines.append(f"# TYPE {metric} gauge")
+        lines += [f"{metric}{labels(record)} {record[key] * scale}" for record in records if record[key] is not None]
+    lines.append("# TYPE hitchmap_job_success gauge")
+    lines.append(f'hitchmap_job_success{{job="{escape(job)}"}} {int(status == "ok")}')
+    lines.append("# TYPE hitchmap_job_last_run_timestamp_seconds gauge")
+    lines.append(f'hitchmap_job_last_run_timestamp_seconds{{job="{escape(job)}"}} {time.time()}')
+
+    filename = "hitchmap-" + re.sub(r"[^\w-]+", "-", job).strip("-") + ".prom"
+    with tempfile.NamedTemporaryFile("w", dir=PROMETHEUS_DIR, suffix=".tmp", delete=False) as f:
+        f.write("\n".join(lines) + "\n")
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, os.path.join(PROMETHEUS_DIR, filename))
@@ -1,35 +1,75 @@
-import os
-import sqlite3
-
 import pandas as pd
+from helpers import get_db
+from instrument import start_job, stage
+
+# Migrations run in order, the database's user_version is the number of migrations applied to it.
+# Only ever append to MIGRATIONS, a migration that already ran on a database isn't run again.
+
+
+def migrate_legacy_columns(con):
+    """Ensure database columns are up to date."""
+    columns = [row[1] for row in con.execute("pragma table_info(points)")]
+    if "user_id" in columns and "nickname" in columns:
+        return
+
+    points = pd.read_sql(sql="select * from points", con=con)
+
+    if "user_id" not in points.columns:
+        points["user_id"] = pd.array([None] * len(points), dtype=pd.Int64Dtype())
+
+    if "from_hitchwiki" not in points.columns:
+        points["from_hitchwiki"] = points["name"].str.contains("(Hitchwiki)")
+        points["name"] = points["name"].str.replace(" (Hitchwiki)", "")
+
+    if "name" in points.columns:
+        points.rename(columns={"name": "nickname"}, inplace=True)
+        # no links for old anonymous reviews
+        points.loc[points.nickname == "Anonymous", "nickname"] = None
 
-root_dir = os.path.join(os.path.dirname(__file__), "..")
+    points.to_sql("points", con, index=False, if_exists="replace")
 
-db_dir = os.path.abspath(os.path.join(root_dir, "db"))
 
-# TODO: Use dotenv?
-if os.path.exists(os.path.join(db_dir, "prod-points.sqlite")):
-    DATABASE = os.path.join(db_dir, "prod-points.sqlite")
-else:
-    DATABASE = os.path.join(db_dir, "points.sqlite")
+def migrate_query_indexes(con):
+    """Indexes for the queries that run on every page build and review submission."""
+    # same schema as in translate-comments.py, which creates it on its first run
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS comment_translations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        point_id INTEGER NOT NULL,
+        language TEXT NOT NULL,
+        translated_comment TEXT,
+        translation_date TEXT NOT NULL,
+        is_original INTEGER NOT NULL DEFAULT 0,
+        UNIQUE (point_id, language)
+    );
+    """)
+    # visible points, loaded by show.py and the other cron jobs
+    con.execute("create index if not exists points_visible on points(banned, revised_by, datetime)")
+    # rate limiting in /experience
+    con.execute("create index if not exists points_ip_datetime on points(ip, datetime)")
+    # reviews of a user on their profile
+    con.execute("create index if not exists points_user_id on points(user_id)")
+    # translations merged by show.py for each language
+    con.execute("create index if not exists comment_translations_language on comment_translations(language, point_id)")
 
-################
-# ensure database columns are up to date
-points = pd.read_sql(
-    sql="select * from points",
-    con=sqlite3.connect(DATABASE),
-)
 
-points["user_id"] = pd.array([None] * len(points), dtype=pd.Int64Dtype())
+MIGRATIONS = [
+    migrate_legacy_columns,
+    migrate_query_indexes,
+]
 
-if "from_hitchwiki" not in points.columns:
-    points["from_hitchwiki"] = points["name"].str.contains("(Hitchwiki)")
-    points["name"] = points["name"].str.replace(" (Hitchwiki)", "")
 
-points.rename(columns={"name": "nickname"}, inplace=True)
+def migrate(con):
+    applied = con.execute("pragma user_version").fetchone()[0]
+    for version, migration in enumerate(MIGRATIONS[applied:], start=applied + 1):
+        print(f"Migrating to version {version}: {migration.__name__}")
+        with stage(migration.__name__), con:
+            migration(con)
+            con.execute(f"pragma user_version = {version}")
+    # updates the statistics the query planner uses to pick indexes
+    con.execute("pragma optimize")
 
-# no links for old anonymous reviews
-points.loc[points.nickname == "Anonymous", "nickname"] = None
 
-points.to_sql("points", sqlite3.connect(DATABASE), index=False, if_exists="replace")
-################
+if __name__ == "__main__":
+    start_job()
+    migrate(get_db())
@@ -0,0 +1,221 @@
+import asyncio
+import contextlib
+import json
+import os
+import random
+import re
+import time
+
+import requests
+
+# Shared fetch layer of fetch-roads.py and fetch-areas.py.
+# Queries run on a pool of workers that take a slot from a token bucket filled from Overpass's /api/status first,
+# so the public instance's rate limit is honored instead of guessed. Failed queries are retried with exponential backoff.
+# Every response is committed to the cache (overpass_cache.py) as it arrives, so a run that is interrupted resumes where
+# it stopped: the next run answers the finished queries from the cache without taking a slot.
+
+# e.g. http://localhost:12345/api to run against a stub or a private instance
+OVERPASS_URL = os.environ.get("HITCHMAP_OVERPASS_URL", "https://overpass-api.de/api").rstrip("/")
+
+# queries in flight at once, the public instance has 2 slots per IP but a private one may not be limited
+WORKERS = int(os.environ.get("HITCHMAP_OVERPASS_WORKERS", 4))
+REQUEST_TIMEOUT = 300
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 2
+BACKOFF_MAX = 300
+# wait when the status page can't be read or tells no time, like the fixed sleep before this existed
+STATUS_RETRY = 1
+# responses worth retrying, 429 is a query over the rate limit and 504 an overloaded server
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+PROGRESS_EVERY = 100
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+class OverpassError(Exception):
+    pass
+
+
+def parse_status(text):
+    """
+    The rate limit, the number of free slots, the seconds until the next busy slot frees up and the number of
+    queries running for this IP from /api/status. A rate limit of 0 means the instance doesn't limit queries.
+    """
+    limit = re.search(r"Rate limit: (\d+)", text)
+    available = re.search(r"(\d+) slots? available now", text)
+    waits = [int(seconds) for seconds in re.findall(r"in (-?\d+) seconds", text)]
+    running = text.partition("Currently running queries")[2].strip().splitlines()[1:]
+    return (
+        int(limit.group(1)) if limit else None,
+        int(available.group(1)) if available else 0,
+        max(min(waits), 0) if waits else None,
+        len(running),
+    )
+
+
+class SlotBucket:
+    """
+    Tokens for the slots Overpass gives this IP. The bucket is filled with the slots /api/status says are free,
+    and only asks again once they are used up, waiting until the next slot frees up if there is none.
+    Queries that were sent but aren't running on the server yet still take a slot, otherwise a status read
+    right after sending them would hand out their slots again.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.tokens = 0
+        # None until the first status, 0 if the instance doesn't limit queries
+        self.limit = None
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            while self.limit != 0 and self.tokens == 0:
+                if self.limit is not None and self.in_flight >= self.limit:
+                    await self.condition.wait()
+                    continue
+                try:
+                    limit, available, wait, running = parse_status(await asyncio.to_thread(self.client.status))
+                except requests.RequestException as e:
+                    print(f"Overpass status: {e}")
+                    limit, available, wait, running = self.limit, 1, STATUS_RETRY, self.in_flight
+                self.limit = limit if limit is not None else 1
+                if self.limit == 0:
+                    break
+                self.tokens = max(min(available - max(self.in_flight - running, 0), self.limit - self.in_flight), 0)
+                if not self.tokens:
+                    # a slot frees up after a while or when one of the queries in flight is answered
+                    with contextlib.suppress(TimeoutError):
+                        await asyncio.wait_for(self.condition.wait(), wait if wait is not None else STATUS_RETRY)
+            if self.limit != 0:
+                self.tokens -= 1
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def empty(self):
+        """Forget the tokens after Overpass refused a query, the next acquire asks for the status again."""
+        self.tokens = 0
+
+
+def get_geohash_cell(lat, lon, precision):
+    """
+    The geohash of the cell a point is in and the cell's bounds as (south, west, north, east), which the batched queries
+    use as tiles. A cell of precision 5 is about 5 by 5 km at the equator, precision 6 about 1.2 by 0.6 km.
+    """
+    bounds = [[-90.0, 90.0], [-180.0, 180.0]]
+    cell = ""
+    index = 0
+    for bit in range(precision * 5):
+        # the even bits halve the longitude, the odd ones the latitude
+        interval, value = (bounds[1], lon) if bit % 2 == 0 else (bounds[0], lat)
+        middle = (interval[0] + interval[1]) / 2
+        index = index * 2 + (value >= middle)
+        interval[value < middle] = middle
+        if bit % 5 == 4:
+            cell += GEOHASH_ALPHABET[index]
+            index = 0
+    (south, north), (west, east) = bounds
+    return cell, (south, west, north, east)
+
+
+def get_backoff(attempt):
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt) * random.uniform(0.5, 1.5)
+
+
+class Overpass:
+    """Runs queries of one kind, see TTLS in overpass_cache.py, with the responses cached in a ResponseCache."""
+
+    def __init__(self, cache, kind, workers=WORKERS):
+        self.cache = cache
+        self.kind = kind
+        self.session = requests.Session()
+        self.workers = workers
+
+    def status(self):
+        response = requests.get(f"{OVERPASS_URL}/status", timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return response.text
+
+    def get(self, query):
+        return self.session.get(f"{OVERPASS_URL}/interpreter", params={"data": query}, timeout=REQUEST_TIMEOUT)
+
+    async def fetch(self, bucket, query):
+        for attempt in range(MAX_ATTEMPTS):
+            await bucket.acquire()
+            try:
+                response = await asyncio.to_thread(self.get, query)
+            except requests.RequestException as e:
+                print(f"Overpass: {e}, attempt {attempt + 1}")
+                response = None
+            finally:
+                await bucket.release()
+
+            if response is None:
+                pass
+            elif response.status_code == 200:
+                try:
+                    data = response.json()
+                except ValueError:
+                    # an error page, e.g. when the query ran out of memory
+                    print(f"Overpass answered with no JSON, attempt {attempt + 1}")
+                else:
+                    self.cache.put(query, self.kind, response.content)
+                    return data
+            elif response.status_code in RETRY_STATUSES:
+                print(f"Overpass answered {response.status_code}, attempt {attempt + 1}")
+                if response.status_code == 429:
+                    bucket.empty()
+            else:
+                raise OverpassError(f"HTTP {response.status_code}: {response.text[:200]}")
+            await asyncio.sleep(get_backoff(attempt))
+        raise OverpassError(f"gave up after {MAX_ATTEMPTS} attempts")
+
+    async def run_async(self, queries, handle):
+        """Fetch the queries that aren't cached on the workers, handle() runs on the event loop one result at a time."""
+        bucket = SlotBucket(self)
+        pending = asyncio.Queue()
+        failed = []
+        done = 0
+        start = time.perf_counter()
+
+        def progress():
+            if done % PROGRESS_EVERY == 0 or done == len(queries):
+                print(f"Overpass: {done}/{len(queries)} done, {len(failed)} failed, {time.perf_counter() - start:.0f}s")
+
+        cached = self.cache.get_many(queries.values())
+        for key, query in queries.items():
+            if query in cached:
+                handle(key, json.loads(cached[query]))
+                done += 1
+            else:
+                pending.put_nowait((key, query))
+        print(f"Overpass: {done} cached, {pending.qsize()} to fetch")
+
+        async def worker():
+            nonlocal done
+            while True:
+                try:
+                    key, query = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    handle(key, await self.fetch(bucket, query))
+                except OverpassError as e:
+                    print(f"Overpass failed for {key}: {e}")
+                    failed.append(key)
+                done += 1
+                progress()
+
+        await asyncio.gather(*[worker() for _ in range(self.workers)])
+        return failed
+
+    def run(self, queries, handle):
+        """
+        Fetch a dict of key to query and call handle(key, data) with each result, cached results first.
+        Returns the keys of the queries that failed after all attempts, a later run retries them.
+        """
+        return asyncio.run(self.run_async(queries, handle))
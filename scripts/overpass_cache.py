@@ -0,0 +1,222 @@
+import collections
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+import zlib
+
+from helpers import db_dir, scripts_dir
+
+# The cache of Overpass responses of fetch-roads.py and fetch-areas.py, see overpass.py.
+# Responses are stored zlib-compressed under the hash of their query with whitespace normalized, so the URL of the
+# instance and the formatting of a query don't matter. Each entry expires after the TTL of its kind of query,
+# and the least recently used entries are evicted once the cache grows beyond its size limit.
+#
+#   python overpass_cache.py stats
+#   python overpass_cache.py compact         remove expired entries, evict down to the size limit and vacuum
+#   python overpass_cache.py import [path]   copy the responses of the requests_cache file the scripts used before
+
+CACHE_PATH = os.path.join(db_dir, "overpass-cache.sqlite")
+LEGACY_CACHE_PATH = os.path.join(scripts_dir, "overpass_api_cache.sqlite")
+# sqlite (default) or memory, which keeps responses for one run only
+BACKEND = os.environ.get("HITCHMAP_OVERPASS_CACHE", "sqlite")
+MAX_SIZE = int(os.environ.get("HITCHMAP_OVERPASS_CACHE_MB", 1024)) * 1024 * 1024
+# eviction goes below the limit, so the next responses don't evict again right away
+EVICT_TO = 0.9
+
+DAY = 24 * 60 * 60
+# seconds a response stays fresh by kind of query, the roads change less often than fuel stations and parkings
+TTLS = {
+    "roads": 365 * DAY,
+    "service_areas": 180 * DAY,
+}
+DEFAULT_TTL = 365 * DAY
+COMPRESSION_LEVEL = 6
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses(accessed_at);
+"""
+
+
+def get_key(query):
+    return hashlib.sha256(" ".join(query.split()).encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Response bodies by query. The backends store compressed bodies by key and implement read(), write(), touch(),
+    remove_expired() and evict(), this class compresses, keys and expires them.
+    """
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+
+    def get_many(self, queries):
+        """The bodies of the queries that have a fresh response, by query. Reading them counts as using them."""
+        keys = {get_key(query): query for query in queries}
+        found = self.read(list(keys), time.time())
+        self.touch(list(found), time.time())
+        return {keys[key]: zlib.decompress(body) for key, body in found.items()}
+
+    def put(self, query, kind, body):
+        now = time.time()
+        compressed = zlib.compress(body, COMPRESSION_LEVEL)
+        self.write(get_key(query), kind, compressed, now, now + TTLS.get(kind, DEFAULT_TTL))
+        if self.size > self.max_size:
+            self.evict(int(self.max_size * EVICT_TO))
+
+    def compact(self):
+        """Remove the expired entries and evict the least recently used ones down to the size limit."""
+        self.remove_expired(time.time())
+        self.evict(self.max_size)
+
+
+class SQLiteCache(ResponseCache):
+    def __init__(self, path=CACHE_PATH, max_size=MAX_SIZE):
+        super().__init__(max_size)
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.execute("pragma journal_mode = wal")
+        self.con.execute("pragma synchronous = normal")
+        self.con.execute("pragma busy_timeout = 5000")
+        self.con.executescript(SCHEMA)
+        self.size = self.con.execute("select coalesce(sum(size), 0) from responses").fetchone()[0]
+
+    def read(self, keys, now):
+        found = {}
+        # in chunks below sqlite's limit of bound parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            found.update(
+                self.con.execute(
+                    f"select key, body from responses where key in ({', '.join('?' * len(chunk))}) and expires_at > ?",
+                    [*chunk, now],
+                )
+            )
+        return found
+
+    def touch(self, keys, now):
+        with self.con:
+            self.con.executemany("update responses set accessed_at = ? where key = ?", [(now, key) for key in keys])
+
+    def write(self, key, kind, body, now, expires_at):
+        with self.con:
+            replaced = self.con.execute("select size from responses where key = ?", (key,)).fetchone()
+            self.con.execute(
+                "insert or replace into responses values (?, ?, ?, ?, ?, ?, ?)",
+                (key, kind, body, len(body), now, expires_at, now),
+            )
+        self.size += len(body) - (replaced[0] if replaced else 0)
+
+    def remove_expired(self, now):
+        with self.con:
+            self.con.execute("delete from responses where expires_at <= ?", (now,))
+        self.size = self.con.execute("select coalesce(sum(size), 0) from responses").fetchone()[0]
+
+    def evict(self, target):
+        """Remove the least recently used entries until the cache is at most target bytes."""
+        with self.con:
+            # the running total of the sizes from the most recently used entry on, everything after the target goes
+            self.con.execute(
+                """
+                delete from responses where key in (
+                    select key from (
+                        select key, sum(size) over (order by accessed_at desc, key) as total from responses
+                    ) where total > ?
+                )
+                """,
+                (target,),
+            )
+        self.size = self.con.execute("select coalesce(sum(size), 0) from responses").fetchone()[0]
+
+    def vacuum(self):
+        self.con.execute("vacuum")
+        # the vacuumed pages are in the WAL until a checkpoint
+        self.con.execute("pragma wal_checkpoint(truncate)")
+
+    def stats(self):
+        return self.con.execute(
+            "select kind, count(*), sum(size), sum(expires_at <= ?) from responses group by kind", (time.time(),)
+        ).fetchall()
+
+
+class MemoryCache(ResponseCache):
+    """Keeps responses for the lifetime of the process, e.g. to run against a local stub without writing a cache file."""
+
+    def __init__(self, max_size=MAX_SIZE):
+        super().__init__(max_size)
+        # key to (kind, body, expires_at), in order of use
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def read(self, keys, now):
+        return {key: self.entries[key][1] for key in keys if key in self.entries and self.entries[key][2] > now}
+
+    def touch(self, keys, now):
+        for key in keys:
+            self.entries.move_to_end(key)
+
+    def write(self, key, kind, body, now, expires_at):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key)[1])
+        self.entries[key] = (kind, body, expires_at)
+        self.size += len(body)
+
+    def remove_expired(self, now):
+        for key in [key for key, (_kind, _body, expires_at) in self.entries.items() if expires_at <= now]:
+            self.size -= len(self.entries.pop(key)[1])
+
+    def evict(self, target):
+        while self.size > target:
+            _key, (_kind, body, _expires_at) = self.entries.popitem(last=False)
+            self.size -= len(body)
+
+
+def open_cache():
+    if BACKEND == "memory":
+        return MemoryCache()
+    if BACKEND == "sqlite":
+        return SQLiteCache()
+    raise ValueError(f"Unknown Overpass cache backend: {BACKEND}")
+
+
+def import_legacy(cache, path):
+    """Copy the responses of a requests_cache file, they are fresh for their TTL from now on."""
+    from urllib.parse import parse_qs, urlparse
+
+    import requests_cache
+
+    count = 0
+    legacy = requests_cache.CachedSession(path.removesuffix(".sqlite"), backend="sqlite")
+    for response in legacy.cache.responses.values():
+        query = parse_qs(urlparse(response.url).query).get("data")
+        if response.status_code != 200 or not query or not response.content.startswith(b"{"):
+            continue
+        # the scripts only sent these two kinds of queries
+        cache.put(query[0], "service_areas" if "is_in" in query[0] else "roads", response.content)
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    cache = SQLiteCache()
+    if "import" in sys.argv:
+        path = sys.argv[sys.argv.index("import") + 1] if len(sys.argv) > sys.argv.index("import") + 1 else LEGACY_CACHE_PATH
+        print(f"Imported {import_legacy(cache, path)} responses from {path}")
+    if "compact" in sys.argv:
+        before = os.path.getsize(CACHE_PATH)
+        cache.compact()
+        cache.vacuum()
+        print(f"Compacted {CACHE_PATH} from {before / 1e6:.1f} MB to {os.path.getsize(CACHE_PATH) / 1e6:.1f} MB")
+    for kind, count, size, expired in cache.stats():
+        print(f"{kind}: {count} responses, {size / 1e6:.1f} MB, {expired} expired")
@@ -1,381 +1,541 @@
+import fcntl
+import functools
+import gzip
+import hashlib
 import html
-import locale
+import json
+import multiprocessing
 import os
+import pickle
 import sys
+import tempfile
 import base64
+import time
+from concurrent.futures import ProcessPoolExecutor
 from jinja2 import Environment, FileSystemLoader
 
 import subprocess
 
-import networkx
+import brotli
 import numpy as np
 import pandas as pd
 import geopandas
 import geopandas as gpd
 import re
-from helpers import get_bearing, haversine_np, root_dir, get_db, slugify, db_dir, scripts_dir
+from columnar import MARKER_ENCODINGS, REVIEW_ENCODINGS, encode_columnar
+import vectortiles
+from instrument import start_job, stage
+from helpers import (
+    find_phrases,
+    get_bearing,
+    get_duplicate_replacements,
+    get_table_versions,
+    haversine_np,
+    replace_coordinates,
+    root_dir,
+    get_db,
+    slugify,
+    db_dir,
+    dist_dir,
+    scripts_dir,
+    touch_build_stamp,
+)
 
 LANG = None
 for arg in sys.argv:
     if re.fullmatch(r"[a-z]{2}", arg):
         LANG = arg
 
-print("LANG", LANG)
-
-dist_dir_root = os.path.abspath(os.path.join(root_dir, "dist"))
+# None is the untranslated page, the others have translated templates and comments, see translate-templates.py
+ALL_LANGS = [None, "pl", "fr", "en"]
 
-if LANG:
-    subprocess.run(["python", "translate-templates.py", LANG], check=True, text=True, cwd=scripts_dir)
-    dist_dir = os.path.abspath(os.path.join(root_dir, "dist", LANG))
-    template_dir = os.path.abspath(os.path.join(dist_dir, "translated-templates"))
+# render several languages from a single pass over the data, e.g. `--langs all` or `--langs default,pl`
+if "--langs" in sys.argv:
+    langs_arg = sys.argv[sys.argv.index("--langs") + 1]
+    LANGS = ALL_LANGS if langs_arg == "all" else [None if lang == "default" else lang for lang in langs_arg.split(",")]
 else:
-    dist_dir = dist_dir_root
-    template_dir = os.path.abspath(os.path.join(root_dir, "templates"))
+    LANGS = [LANG]
 
-# Set up Jinja2 environment
-env = Environment(loader=FileSystemLoader(template_dir))  # Load templates from current directory
-template = env.get_template("index_template.html")  # Load template file
-service_template = env.get_template("service_template.html")  # Load template file
-service_index = env.get_template("service_index.html")  # Load template file
-city_index = env.get_template("city_index.html")  # Load template file
-city_template = env.get_template("city_template.html")  # Load template file
-country_index = env.get_template("country_index.html")  # Load template file
-country_template = env.get_template("country_template.html")  # Load template file
+print("LANGS", LANGS)
 
-os.makedirs(dist_dir, exist_ok=True)
+dist_dir_root = dist_dir
 
 LIGHT = "light" in sys.argv
 SERVICE_AREAS = "service" in sys.argv
 CITIES = "city" in sys.argv
 COUNTRIES = "country" in sys.argv
+# only rebuild what changed since the last run, see get_change_cursor
+INCREMENTAL = "incremental" in sys.argv and not (SERVICE_AREAS or CITIES or COUNTRIES)
+# render the languages in a process pool
+PARALLEL = "parallel" in sys.argv
+# reference the data, script and style from the page as separate content-addressed files, instead of embedding them
+SPLIT = "split" in sys.argv
+# send reviews and markers as typed columns instead of rows, see columnar.py
+COLUMNAR = "columnar" in sys.argv
+# write vector tiles of the spots to dist/tiles
+TILES = "tiles" in sys.argv
+# where the page loads them from, see js/spot-tiles.js
+SPOT_TILES_URL = "/tiles/{z}/{x}/{y}.mvt"
+
+# in-place edits to points (e.g. through datasette) are not part of the change cursor, so fall back to a full rebuild regularly
+FULL_REBUILD_INTERVAL = 60 * 60
+
+data_dir = os.path.join(dist_dir_root, "data")
+# unreferenced data files are kept around this long for clients that loaded an older page
+DATA_FILE_RETENTION = 7 * 24 * 60 * 60
+
+# the data is language independent, so all languages share one cache
+cache_file = os.path.join(db_dir, "show-cache-index" + ("-light" if LIGHT else "") + ".pkl")
+
+VISIBLE_POINTS = "not banned and revised_by is null"
+
+# spots for the /api/spots endpoint of the server, see backend/spots.py
+spots_file = os.path.join(db_dir, "spots.pkl")
+SPOT_COLUMNS = ["lat", "lon", "rating", "wait", "ride_distance", "review_count", "country", "service_area_name"]
+# reviews for the /api/reviews/search endpoint, see backend/reviews.py
+reviews_file = os.path.join(db_dir, "reviews.pkl")
+REVIEW_COLUMNS = ["short_id", "hitchhiker", "datetime", "ride_datetime", "comment", "ride_distance", "dest_lat", "dest_lon"]
+
+# show_state job that remembers which geometries point_spatial_assignment was computed with
+SPATIAL_ASSIGNMENT_JOB = "spatial-assignment"
+SPATIAL_ASSIGNMENT_COLUMNS = ["service_area_id", "service_area_name", "road_island_id", "cluster_id"]
+
+
+def get_dist_dir(lang):
+    return os.path.join(dist_dir_root, lang) if lang else dist_dir_root
+
+
+def get_template_dir(lang):
+    if lang:
+        return os.path.abspath(os.path.join(get_dist_dir(lang), "translated-templates"))
+    return os.path.abspath(os.path.join(root_dir, "templates"))
+
+
+def get_outname(lang):
+    return os.path.join(get_dist_dir(lang), "light.html" if LIGHT else "index.html")
+
+
+def get_job_name(lang):
+    return "index" + ("-light" if LIGHT else "") + (f"-{lang}" if lang else "")
+
+
+def get_change_cursor(con):
+    """
+    Cheap fingerprint of the data the main page is built from. It is compared against the cursor of the previous run
+    to decide whether anything has to be rebuilt at all, and if so, whether new reviews can be merged into the
+    previous result or a full rebuild is needed.
+    """
+    return {
+        # new reviews
+        "points": con.execute("select max(rowid), max(datetime) from points").fetchone(),
+        # banned and revised reviews, which disappear from the map
+        "hidden": con.execute(
+            """select count(*), total(case when banned then rowid end), total(case when revised_by is not null then rowid end)
+            from points"""
+        ).fetchone(),
+        "duplicates": con.execute(
+            "select count(*), max(rowid), total(case when reviewed = accepted then rowid end) from duplicates"
+        ).fetchone(),
+        "geometries": (
+            con.execute("select count(*), max(rowid), total(length(geometry_wkt)) from service_areas").fetchone(),
+            con.execute("select count(*), max(rowid), total(length(geometry_wkt)) from road_islands").fetchone(),
+            # fetch-areas.py and fetch-roads.py give the tables a new version whenever they rewrite them
+            get_table_versions(con, ["service_areas", "road_islands"]),
+        ),
+    }
 
-outname = os.path.join(dist_dir, "light.html") if LIGHT else os.path.join(dist_dir, "index.html")
 
-outname_recent = os.path.join(dist_dir, "recent.html")
-outname_dups = os.path.join(dist_dir, "recent-dups.html")
+def get_language_cursor(con, lang):
+    """The part of the change cursor that differs per language: translated comments and everything rendered besides the data."""
+    template_dir = get_template_dir(lang)
+    code_files = [
+        os.path.join(template_dir, "index_template.html"),
+        os.path.join(template_dir, "index_root.html"),
+        os.path.join(root_dir, "static", "style.css"),
+        os.path.join(root_dir, "package.json"),
+        __file__,
+    ] + [os.path.join(root_dir, "js", f) for f in sorted(os.listdir(os.path.join(root_dir, "js")))]
+
+    return {
+        "translations": (
+            con.execute("select count(*), max(rowid) from comment_translations where language = ?", (lang,)).fetchone()
+            if lang
+            else None
+        ),
+        "code": [os.path.getmtime(f) for f in code_files if os.path.exists(f)],
+    }
 
-# keep right before reading the points
-generation_date = pd.Timestamp.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")
 
+def load_points(con, sql, params=()):
+    points = pd.read_sql(sql=sql, con=con, params=params)
+    # a handful of new reviews can have only nulls in a column, which wouldn't be read as numeric
+    points = points.astype({"lat": float, "lon": float, "dest_lat": float, "dest_lon": float, "wait": float})
+    points["user_id"] = points["user_id"].astype(pd.Int64Dtype())
+    return points
 
-points = pd.read_sql(
-    sql="select * from points where not banned and revised_by is null order by datetime is not null desc, datetime desc",
-    con=get_db(),
-)
 
-points["user_id"] = points["user_id"].astype(pd.Int64Dtype())
+def load_geometries(con):
+    def load(table, columns):
+        df = pd.read_sql(f"select * from {table}", con)
+        # fetch-areas.py and fetch-roads.py also store WKB, which is a lot faster to parse
+        geometry = gpd.GeoSeries.from_wkb(df.geometry_wkb) if "geometry_wkb" in df else gpd.GeoSeries.from_wkt(df.geometry_wkt)
+        return gpd.GeoDataFrame(df[columns], geometry=geometry, crs="EPSG:4326")
 
-duplicates = pd.read_sql("select * from duplicates where reviewed = accepted", get_db())
+    return load("service_areas", ["geom_id", "name"]), load("road_islands", ["id"])
 
-# merging and transforming data
-dup_rads = duplicates[["from_lon", "from_lat", "to_lon", "to_lat"]].values.T
 
-duplicates["distance"] = haversine_np(*dup_rads)
-duplicates["from"] = duplicates[["from_lat", "from_lon"]].apply(tuple, axis=1)
-duplicates["to"] = duplicates[["to_lat", "to_lon"]].apply(tuple, axis=1)
+def reset_spatial_assignment(con, geometries_cursor):
+    """Forget the stored spatial assignments if the service areas or road islands changed since they were computed."""
+    stored = con.execute("select cursor from show_state where job = ?", (SPATIAL_ASSIGNMENT_JOB,)).fetchone()
+    if stored is None or json.loads(stored[0]) != geometries_cursor:
+        con.execute("delete from point_spatial_assignment")
+        con.execute(
+            "insert or replace into show_state (job, cursor, updated_at) values (?, ?, ?)",
+            (SPATIAL_ASSIGNMENT_JOB, json.dumps(geometries_cursor), generation_date),
+        )
+        con.commit()
+        print("Geometries changed, recomputing the spatial assignment of all points")
 
-duplicates = duplicates[duplicates.distance < 1.25]
 
-dups = networkx.from_pandas_edgelist(duplicates, "from", "to")
-islands = networkx.connected_components(dups)
+def compute_spatial_assignment(points, service_area_geoms, road_island_geoms):
+    points = gpd.GeoDataFrame(points[["id", "lat", "lon"]], geometry=gpd.points_from_xy(points.lon, points.lat), crs="EPSG:4326")
 
-replace_map = {}
+    points_service_area = points.sjoin(service_area_geoms, how="left").sort_values("geom_id").drop_duplicates("id")
+    points["service_area_id"] = points_service_area["geom_id"]
+    points["service_area_name"] = points_service_area["name"]
 
-for island in islands:
-    parents = [node for node in island if node not in duplicates["from"].tolist()]
+    points["road_island_id"] = points.sjoin(road_island_geoms, how="left").drop_duplicates("id_left")["id_right"]
 
-    if len(parents) == 1:
-        for node in island:
-            if node != parents[0]:
-                replace_map[node] = parents[0]
+    # pseudo-random cluster id based on lat/lon
+    points["cluster_id"] = (points.lat * 1e10 + points.lon * 1e10).round()
 
-print("Currently recorded duplicate spots are represented by:", dups)
+    has_road_island = points.road_island_id.notna()
+    points.loc[has_road_island, "cluster_id"] = points[has_road_island].road_island_id + 1e9
 
-points[["lat", "lon"]] = points[["lat", "lon"]].apply(lambda x: replace_map.get(tuple(x), x), axis=1, raw=True)
+    has_service_area = points.service_area_id.notna()
+    points.loc[has_service_area, "cluster_id"] = points[has_service_area].service_area_id + 5e9
 
-points = geopandas.GeoDataFrame(points, geometry=geopandas.points_from_xy(points.lon, points.lat), crs="EPSG:4326")
+    return pd.DataFrame(points[["id", "lat", "lon", *SPATIAL_ASSIGNMENT_COLUMNS]])
 
-service_areas = pd.read_sql("select * from service_areas", get_db())
-service_area_geoms = gpd.GeoDataFrame(
-    service_areas[["geom_id", "name"]],
-    geometry=gpd.GeoSeries.from_wkt(service_areas.geometry_wkt),
-    crs="EPSG:4326",
-)
 
-points_service_area = points.sjoin(service_area_geoms, how="left").sort_values("geom_id").drop_duplicates("id")
-points["service_area_id"] = points_service_area["geom_id"]
-points["service_area_name"] = points_service_area["name"]
+def get_spatial_assignment(con, points):
+    """
+    Service area, road island and cluster of the points, aligned with points. They are read from point_spatial_assignment,
+    only points that aren't in it yet or whose coordinates changed through a new duplicate are joined with the geometries.
+    """
+    stored = pd.read_sql(
+        "select * from point_spatial_assignment where point_id in (select value from json_each(?))",
+        con,
+        params=(points.id.to_json(orient="values"),),
+    )
+    assigned = points[["id", "lat", "lon"]].merge(
+        stored, left_on="id", right_on="point_id", how="left", suffixes=("", "_assigned")
+    )
+    missing = ~((assigned.lat == assigned.lat_assigned) & (assigned.lon == assigned.lon_assigned)).to_numpy()
+
+    if missing.any():
+        computed = compute_spatial_assignment(points[missing], *load_geometries(con))
+        con.executemany(
+            f"insert or replace into point_spatial_assignment (point_id, lat, lon, {', '.join(SPATIAL_ASSIGNMENT_COLUMNS)})"
+            " values (?, ?, ?, ?, ?, ?, ?)",
+            computed.astype(object).where(computed.notna(), None).itertuples(index=False),
+        )
+        con.commit()
+        assigned.loc[missing, SPATIAL_ASSIGNMENT_COLUMNS] = computed[SPATIAL_ASSIGNMENT_COLUMNS].to_numpy()
+        print(f"Spatially joined {missing.sum()} points")
+
+    assigned = assigned[SPATIAL_ASSIGNMENT_COLUMNS].set_axis(points.index)
+    return assigned.astype({"service_area_id": float, "road_island_id": float, "cluster_id": float})
 
-road_islands = pd.read_sql("select * from road_islands", get_db())
-road_island_geoms = gpd.GeoDataFrame(
-    road_islands[["id"]],
-    geometry=gpd.GeoSeries.from_wkt(road_islands.geometry_wkt),
-    crs="EPSG:4326",
-)
 
-points["road_island_id"] = points.sjoin(road_island_geoms, how="left").drop_duplicates("id_left")["id_right"]
+def e(s):
+    s2 = s.copy()
+    s2.loc[~s2.isnull()] = s2.loc[~s2.isnull()].map(lambda x: html.escape(x).replace("\n", "<br>"))
+    return s2
+
+
+def process_points(con, points, replacements, users):
+    """Everything that can be derived per review, independent of the other reviews and of the language."""
+    points = replace_coordinates(points, replacements)
+
+    points = geopandas.GeoDataFrame(points, geometry=geopandas.points_from_xy(points.lon, points.lat), crs="EPSG:4326")
+    with stage("sjoin"):
+        points[SPATIAL_ASSIGNMENT_COLUMNS] = get_spatial_assignment(con, points)
+
+    # fix hitchwiki comments
+    points.loc[points.id.isin(range(1000000, 1040000)), "comment"] = (
+        points.loc[points.id.isin(range(1000000, 1040000)), "comment"]
+        .str.encode("cp1252", errors="ignore")
+        .str.decode("utf-8", errors="ignore")
+    )
+
+    points["datetime"] = pd.to_datetime(points.datetime)
+    points["ride_datetime"] = pd.to_datetime(points.ride_datetime, errors="coerce")  # handels invalid dates
+
+    rads = points[["lon", "lat", "dest_lon", "dest_lat"]].values.T
+
+    points["ride_distance"] = haversine_np(*rads)
+    points["direction"] = get_bearing(*rads)
+
+    points.loc[(points.ride_distance < 1), "dest_lat"] = None
+    points.loc[(points.ride_distance < 1), "dest_lon"] = None
+    points.loc[(points.ride_distance < 1), "direction"] = None
+    points.loc[(points.ride_distance < 1), "ride_distance"] = None
+
+    rounded_dir = 45 * np.round(points.direction / 45)
+    points["arrows"] = rounded_dir.replace(
+        {
+            -90: "←",
+            90: "→",
+            0: "↑",
+            180: "↓",
+            -180: "↓",
+            -45: "↖",
+            45: "↗",
+            135: "↘",
+            -135: "↙",
+        }
+    )
+
+    rating_text = "rating: " + points.rating.astype(int).astype(str) + "/5"
+    destination_text = (
+        ", ride: " + np.round(points.ride_distance).astype(str).str.replace(".0", "", regex=False) + " km " + points.arrows
+    )
+
+    points["wait_text"] = None
+    has_accurate_wait = ~points.wait.isnull() & ~points.datetime.isnull()
+    points.loc[has_accurate_wait, "wait_text"] = (
+        ", wait: "
+        + points.wait[has_accurate_wait].astype(int).astype(str)
+        + " min"
+        + (
+            " " + points.signal[has_accurate_wait].replace({"ask": "💬", "ask-sign": "💬+🪧", "sign": "🪧", "thumb": "👍"})
+        ).fillna("")
+    )
+
+    points["extra_text"] = rating_text + points.wait_text.fillna("") + destination_text.fillna("")
+
+    points["username"] = pd.merge(
+        left=points[["user_id"]],
+        right=users[["id", "username"]],
+        left_on="user_id",
+        right_on="id",
+        how="left",
+    )["username"].values
+    # stays a string column when a handful of new reviews are all anonymous
+    points["hitchhiker"] = points["nickname"].where(points["nickname"].notna(), points["username"]).astype(object)
+
+    points["user_link"] = ("<a href='/?user=" + e(points["hitchhiker"]) + "'>" + e(points["hitchhiker"]) + "</a>").fillna(
+        "Anonymous"
+    )
+
+    # base64 encoded id
+    points["short_id"] = points["id"].apply(lambda x: base64.urlsafe_b64encode(x.to_bytes(8, "big")).decode("ascii"))
+
+    points["datetime_str"] = points.datetime.dt.strftime(", %B %Y").fillna("")
+    points["hitchhiker_str"] = points.hitchhiker.fillna("Anonymous")
+
+    return points
+
+
+def aggregate_places(points):
+    """Aggregate reviews into one row per spot (cluster_id), leaving out the review indices."""
+    groups = points.groupby("cluster_id")
 
+    places = groups[["country", "service_area_name"]].first()
+    places["rating"] = groups.rating.mean().round()
+    places["wait"] = points[~points.wait.isnull()].groupby("cluster_id").wait.mean()
+    places["ride_distance"] = points[~points.ride_distance.isnull()].groupby("cluster_id").ride_distance.mean()
+    # places["text"] = groups.text.apply(lambda t: "<hr>".join(t.dropna()))
+    places["text"] = ""
+    places["review_count"] = groups.size()
 
-# pseudo-random cluster id based on lat/lon
-points["cluster_id"] = (points.lat * 1e10 + points.lon * 1e10).round()
+    # to prevent confusion, only add a review user if they have a text written
+    # places["reviews"] = (
+    #     points.dropna(subset=["text", "hitchhiker"]).groupby("cluster_id")
+    #     .apply(lambda g: list(zip(g.hitchhiker, g.ride_datetime)))
+    # )
 
-has_road_island = points.road_island_id.notna()
-points.loc[has_road_island, "cluster_id"] = points[has_road_island].road_island_id + 1e9
+    places["dest_lats"] = points.dropna(subset=["dest_lat", "dest_lon"]).groupby("cluster_id").dest_lat.apply(list)
+    places["dest_lons"] = points.dropna(subset=["dest_lat", "dest_lon"]).groupby("cluster_id").dest_lon.apply(list)
+    places["lat"] = groups.lat.mean()
+    places["lon"] = groups.lon.mean()
+    return places
 
-has_service_area = points.service_area_id.notna()
-points.loc[has_service_area, "cluster_id"] = points[has_service_area].service_area_id + 5e9
+
+start_job()
+
+con = get_db()
+con.execute("create table if not exists show_state (job text primary key, cursor text, updated_at text)")
+# service area, road island and cluster of each point, see get_spatial_assignment
+con.execute(
+    """create table if not exists point_spatial_assignment (point_id integer primary key, lat real, lon real,
+    service_area_id integer, service_area_name text, road_island_id integer, cluster_id real)"""
+)
 
 try:
-    users = pd.read_sql("select * from user", get_db())
+    users = pd.read_sql("select * from user", con)
 except pd.errors.DatabaseError:
     raise Exception("Run server.py to create the user table") from None
 
-print(f"{len(points)} points currently")
+if any(LANGS):
+    # without a language argument, all languages are translated
+    translate_args = [LANGS[0]] if len(LANGS) == 1 else []
+    subprocess.run(["python", "translate-templates.py", *translate_args], check=True, text=True, cwd=scripts_dir)
 
-# fix hitchwiki comments
-points.loc[points.id.isin(range(1000000, 1040000)), "comment"] = (
-    points.loc[points.id.isin(range(1000000, 1040000)), "comment"]
-    .str.encode("cp1252", errors="ignore")
-    .str.decode("utf-8", errors="ignore")
-)
+# keep right before reading the points
+generation_date = pd.Timestamp.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")
 
-points["datetime"] = pd.to_datetime(points.datetime)
-points["ride_datetime"] = pd.to_datetime(points.ride_datetime, errors="coerce")  # handels invalid dates
-
-rads = points[["lon", "lat", "dest_lon", "dest_lat"]].values.T
-
-points["ride_distance"] = haversine_np(*rads)
-points["direction"] = get_bearing(*rads)
-
-points.loc[(points.ride_distance < 1), "dest_lat"] = None
-points.loc[(points.ride_distance < 1), "dest_lon"] = None
-points.loc[(points.ride_distance < 1), "direction"] = None
-points.loc[(points.ride_distance < 1), "ride_distance"] = None
-
-rounded_dir = 45 * np.round(points.direction / 45)
-points["arrows"] = rounded_dir.replace(
-    {
-        -90: "←",
-        90: "→",
-        0: "↑",
-        180: "↓",
-        -180: "↓",
-        -45: "↖",
-        45: "↗",
-        135: "↘",
-        -135: "↙",
-    }
-)
+cursor = get_change_cursor(con)
+# round trip through JSON so they compare equal to the stored cursors
+lang_cursors = {lang: json.loads(json.dumps({**cursor, **get_language_cursor(con, lang)})) for lang in LANGS}
+cursor = json.loads(json.dumps(cursor))
+
+langs_to_render = LANGS
+if INCREMENTAL:
+    stored_cursors = dict(con.execute("select job, cursor from show_state").fetchall())
+    langs_to_render = [
+        lang
+        for lang in LANGS
+        if json.loads(stored_cursors.get(get_job_name(lang), "null")) != lang_cursors[lang]
+        or not os.path.exists(get_outname(lang))
+    ]
 
+    if not langs_to_render:
+        print("Nothing changed since the last run")
+        sys.exit()
 
-rating_text = "rating: " + points.rating.astype(int).astype(str) + "/5"
-destination_text = (
-    ", ride: " + np.round(points.ride_distance).astype(str).str.replace(".0", "", regex=False) + " km " + points.arrows
-)
+reset_spatial_assignment(con, cursor["geometries"])
 
+cache = None
+if INCREMENTAL and os.path.exists(cache_file):
+    with open(cache_file, "rb") as f:
+        cache = pickle.load(f)
+    # merging new reviews into the previous result is only valid if the reviews are the only thing that changed
+    if (
+        "replacements" not in cache
+        or cache["cursor"]["duplicates"] != cursor["duplicates"]
+        or cache["cursor"]["geometries"] != cursor["geometries"]
+        or time.time() - cache["full_rebuild_time"] > FULL_REBUILD_INTERVAL
+    ):
+        cache = None
 
-points["wait_text"] = None
-has_accurate_wait = ~points.wait.isnull() & ~points.datetime.isnull()
-points.loc[has_accurate_wait, "wait_text"] = (
-    ", wait: "
-    + points.wait[has_accurate_wait].astype(int).astype(str)
-    + " min"
-    + (" " + points.signal[has_accurate_wait].replace({"ask": "💬", "ask-sign": "💬+🪧", "sign": "🪧", "thumb": "👍"})).fillna("")
-)
+with stage("load"):
+    duplicates = pd.read_sql("select * from duplicates where reviewed = accepted", con)
 
+# merging and transforming data
+dup_rads = duplicates[["from_lon", "from_lat", "to_lon", "to_lat"]].values.T
 
-def e(s):
-    s2 = s.copy()
-    s2.loc[~s2.isnull()] = s2.loc[~s2.isnull()].map(lambda x: html.escape(x).replace("\n", "<br>"))
-    return s2
+duplicates["distance"] = haversine_np(*dup_rads)
+
+duplicates = duplicates[duplicates.distance < 1.25]
 
+if cache:
+    # only process reviews that are new or became visible again, and drop the ones that were banned or revised
+    cached_points, replacements = cache["points"], cache["replacements"]
+    with stage("load") as load:
+        visible_ids = pd.read_sql(f"select id from points where {VISIBLE_POINTS}", con).id
+        new_ids = visible_ids[~visible_ids.isin(cached_points.id)]
+        removed = ~cached_points.id.isin(visible_ids)
+
+        new_points = load_points(
+            con, "select * from points where id in (select value from json_each(?))", (new_ids.to_json(orient="values"),)
+        )
+        load.rows = len(new_points)
+    with stage("features"):
+        new_points = process_points(con, new_points, replacements, users) if len(new_points) else cached_points.iloc[:0]
+
+    affected_clusters = pd.concat([new_points.cluster_id, cached_points.cluster_id[removed]]).unique()
+
+    points = (
+        pd.concat([new_points, cached_points[~removed]])
+        .sort_values("datetime", ascending=False, na_position="last", kind="stable")
+        .reset_index(drop=True)
+    )
+    points = geopandas.GeoDataFrame(points, geometry="geometry", crs="EPSG:4326")
+
+    with stage("groupby"):
+        places = pd.concat(
+            [
+                cache["places"].drop(affected_clusters, errors="ignore"),
+                aggregate_places(points[points.cluster_id.isin(affected_clusters)]),
+            ]
+        ).sort_index()
+    full_rebuild_time = cache["full_rebuild_time"]
+
+    print(f"Incremental update: {len(new_points)} new reviews, {removed.sum()} removed, {len(affected_clusters)} spots affected")
+else:
+    with stage("load") as load:
+        points = load_points(
+            con, f"select * from points where {VISIBLE_POINTS} order by datetime is not null desc, datetime desc"
+        )
+        load.rows = len(points)
+    with stage("dedupe"):
+        replacements = get_duplicate_replacements(duplicates)
+    print("Duplicate spots replaced by the spot representing them:", len(replacements))
+
+    with stage("features"):
+        points = process_points(con, points, replacements, users)
+    with stage("groupby") as groupby:
+        places = aggregate_places(points)
+        groupby.rows = len(places)
+    full_rebuild_time = time.time()
 
-points["extra_text"] = rating_text + points.wait_text.fillna("") + destination_text.fillna("")
+print(f"{len(points)} points currently")
 
 comment_nl = points["comment"] + "\n\n"
 
 # show review without comments in the sidebar if they're new; old reviews may be aggregate ratings that don't make sense
 comment_nl.loc[(points.datetime.dt.year > 2021) & points.comment.isnull()] = ""
 
-points["username"] = pd.merge(
-    left=points[["user_id"]],
-    right=users[["id", "username"]],
-    left_on="user_id",
-    right_on="id",
-    how="left",
-)["username"]
-points["hitchhiker"] = points["nickname"].fillna(points["username"])
-
-points["user_link"] = ("<a href='/?user=" + e(points["hitchhiker"]) + "'>" + e(points["hitchhiker"]) + "</a>").fillna("Anonymous")
-
-# base64 encoded id
-points["short_id"] = points["id"].apply(lambda x: base64.urlsafe_b64encode(x.to_bytes(8, "big")).decode("ascii"))
-
-points["datetime_str"] = points.datetime.dt.strftime(", %B %Y").fillna("")
-points["hitchhiker_str"] = points.hitchhiker.fillna("Anonymous")
-
-if LANG:
-    translations_df = pd.read_sql(
-        """SELECT point_id, translated_comment, is_original
-        FROM comment_translations
-        WHERE language = ?
-        """,
-        get_db(),
-        params=(LANG,),
-    )
-
-    # Merge translations with points
-    points = points.merge(translations_df, left_on="id", right_on="point_id", how="left")
+js_output_file = os.path.join(dist_dir_root, "out.js")
 
-    # Replace comment with translation where available, otherwise keep original
-    points["comment"] = points["translated_comment"].fillna(points["comment"])
 
-    # Set is_original: True if no translation exists (NaN), otherwise use the value from translations
-    points["is_original"] = points["is_original"].fillna(True).astype(bool)
+def build_js():
+    """
+    Bundle the JS with esbuild, unless the bundle was already built from the current sources.
+    Starting node is the slowest part of a run, and the sources rarely change.
+    """
+    digest = hashlib.sha256()
+    source_files = [os.path.join(root_dir, "package.json"), os.path.join(root_dir, "package-lock.json")]
+    for dirpath, _dirnames, filenames in os.walk(os.path.join(root_dir, "js")):
+        source_files += [os.path.join(dirpath, filename) for filename in filenames]
+    for source_file in sorted(filter(os.path.exists, source_files)):
+        digest.update(os.path.relpath(source_file, root_dir).encode())
+        with open(source_file, "rb") as f:
+            digest.update(f.read())
+    source_hash = digest.hexdigest()
 
-    # Clean up temporary columns
-    points.drop(columns=["point_id", "translated_comment"], inplace=True)
-else:
-    points["is_original"] = True
-
-groups = points.groupby("cluster_id")
-
-print("After clustering:", len(groups), "Before:", len(points.geometry.drop_duplicates()))
-
-# Create individual review data with all fields needed for rendering
-review_data = points[
-    [
-        "lat",
-        "lon",
-        "rating",
-        "wait",
-        "comment",
-        "ride_distance",
-        "arrows",
-        "hitchhiker",
-        "datetime",
-        "ride_datetime",
-        "country",
-        "dest_lat",
-        "dest_lon",
-        "short_id",
-        "is_original",
-    ]
-].copy()
-
-# Add a unique index for each review
-review_data["review_index"] = review_data.index
-
-# Convert to JSON-serializable format
-review_data_json = review_data.to_json(orient="values")
-review_columns = review_data.columns.to_series().to_json(orient="values")
-
-places = groups[["country", "service_area_name"]].first()
-places["rating"] = groups.rating.mean().round()
-places["wait"] = points[~points.wait.isnull()].groupby("cluster_id").wait.mean()
-places["ride_distance"] = points[~points.ride_distance.isnull()].groupby("cluster_id").ride_distance.mean()
-# places["text"] = groups.text.apply(lambda t: "<hr>".join(t.dropna()))
-places["text"] = ""
-places["review_count"] = groups.size()
-# Store indices of reviews instead of the text
-places["review_indices"] = groups.apply(lambda g: g.index.tolist())
-
-# to prevent confusion, only add a review user if they have a text written
-# places["reviews"] = (
-#     points.dropna(subset=["text", "hitchhiker"]).groupby("cluster_id").apply(lambda g: list(zip(g.hitchhiker, g.ride_datetime)))
-# )
-
-places["dest_lats"] = points.dropna(subset=["dest_lat", "dest_lon"]).groupby("cluster_id").dest_lat.apply(list)
-places["dest_lons"] = points.dropna(subset=["dest_lat", "dest_lon"]).groupby("cluster_id").dest_lon.apply(list)
-places["lat"] = groups.lat.mean()
-places["lon"] = groups.lon.mean()
-
-
-if LIGHT:
-    places = places[(places.text.str.len() > 0) | ~places.ride_distance.isnull()]
-elif SERVICE_AREAS:
-    service_area_folder = os.path.join(dist_dir, "service-area")
-    os.makedirs(service_area_folder, exist_ok=True)
-    service_places = places.loc[places.service_area_name.notna()].copy()
-    service_places["text_len"] = service_places.text.str.len()
-    service_places["slug"] = service_places.service_area_name.apply(slugify)
-    service_places = service_places.sort_values("text_len", ascending=False).drop_duplicates("slug")
-    for _i, place in service_places.iterrows():
-        rendered = service_template.render(place=place, title=place["service_area_name"])
-        with open(os.path.join(service_area_folder, f"{place['slug']}.html"), "w") as f:
-            f.write(rendered)
-    index_rendered = service_index.render(grouped_places=service_places.groupby("country"))
-    with open(os.path.join(service_area_folder, "index.html"), "w") as f:
-        f.write(index_rendered)
-elif CITIES:
-    points.sort_values("datetime", inplace=True, ascending=False)
-    cities = pd.read_csv(os.path.join(db_dir, "cities.csv")).drop_duplicates().sort_values("city")
-    rendered_cities = []
-
-    for city in cities.itertuples():
-        country_folder = os.path.join(dist_dir, "city", city.country)
-        os.makedirs(country_folder, exist_ok=True)
-        pattern = rf"\b{city.city}\b"
-        city_reviews = (
-            points[points.comment.str.contains(pattern, case=False, regex=True).astype(bool)].dropna(subset="comment").iloc[:20]
-        )
-        rendered_cities.append(len(city_reviews) >= 3)
-        if rendered_cities[-1]:
-            rendered = city_template.render(city=city, title=city.city, reviews=city_reviews)
-            with open(os.path.join(country_folder, f"{city.city}.html"), "w") as f:
-                f.write(rendered)
-
-    print(rendered_cities)
-
-    index_rendered = city_index.render(grouped_cities=cities[rendered_cities].groupby("country"))
-    with open(os.path.join(os.path.join(dist_dir, "city"), "index.html"), "w") as f:
-        f.write(index_rendered)
-elif COUNTRIES:
-    points.sort_values("datetime", inplace=True, ascending=False)
-    countries = pd.read_csv(os.path.join(db_dir, "countries.csv")).drop_duplicates().sort_values("country")
-    rendered_countries = []
-    country_folder = os.path.join(dist_dir, "country")
-    os.makedirs(country_folder, exist_ok=True)
-
-    for country in countries.itertuples():
-        pattern = rf"\b{country.name}\b"
-        mention_reviews = (
-            points[points.comment.str.contains(pattern, case=False, regex=True).astype(bool)].dropna(subset="comment").iloc[:20]
-        )
-        country_reviews = points[points.country == country.country].dropna(subset="comment").iloc[:20]
-        rendered_countries.append(len(mention_reviews) >= 3)
-        if rendered_countries[-1]:
-            rendered = country_template.render(
-                country=country, title=country.country, mention_reviews=mention_reviews, country_reviews=country_reviews
-            )
-            with open(os.path.join(country_folder, f"{country.name}.html"), "w") as f:
-                f.write(rendered)
-    print(rendered_countries)
-    index_rendered = country_index.render(countries=countries[rendered_countries])
-    with open(os.path.join(country_folder, "index.html"), "w") as f:
-        f.write(index_rendered)
+    hash_file = js_output_file + ".sha256"
 
+    # other show.py runs (e.g. the guide pages) may be building at the same time
+    os.makedirs(dist_dir_root, exist_ok=True)
+    with open(os.path.join(dist_dir_root, ".build.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
 
-# z-index is rating + 2 * number of reviews + 2 * number of reviews with destination
-places["z-index"] = places["rating"] + 2 * places["review_count"] + 2 * places["dest_lats"].str.len().fillna(0)
+        if os.path.exists(js_output_file) and os.path.exists(hash_file):
+            with open(hash_file) as f:
+                if f.read() == source_hash:
+                    return
 
-places.reset_index(inplace=True)
-# make sure high-rated are on top
-places.sort_values("z-index", inplace=True, ascending=True)
+        try:
+            subprocess.run(["npm", "run", "build"], check=True, text=True, cwd=root_dir)
+        except subprocess.CalledProcessError:
+            print("DID NOT BUILD JS")
+            return
 
-marker_data = places[["lat", "lon", "rating", "text", "wait", "ride_distance", "review_indices"]].to_json(orient="values")
+        with open(hash_file, "w") as f:
+            f.write(source_hash)
 
-try:
-    subprocess.run(["npm", "run", "build"], check=True, text=True)
-except subprocess.CalledProcessError as e:
-    print("DID NOT BUILD JS")
 
-js_output_file = os.path.join(dist_dir_root, "out.js")
+with stage("build_js"):
+    build_js()
 
 # We embed everything directly into the HTML page so our service worker can't serve inconsistent files
 # For example, if we add a new attribute to the spot which is shown in the front-end, but the user only gets the new
 # presentation layer, not the new data, the application would break
 # Because the HTML file contains everything, this is not a problem
+# In split mode, the page only references content-addressed files instead, which pins the versions together just the same
 
 with open(js_output_file, encoding="utf-8") as f:
     hitch_script = f.read()
@@ -383,35 +543,424 @@ with open(js_output_file, encoding="utf-8") as f:
 with open(os.path.join(root_dir, "static", "style.css"), encoding="utf-8") as f:
     hitch_style = f.read()
 
-output = template.render(
-    {
-        "hitch_script": hitch_script,
-        "hitch_style": hitch_style,
-        "markers": marker_data,
-        "review_data": review_data_json,
-        "review_columns": review_columns,
-        "generation_date": generation_date,
-    }
-)
 
-with open(outname, "w", encoding="utf-8") as f:
-    f.write(output)
+# the precompressed copies next to a file, which the server sends to clients accepting the encoding
+COMPRESSIONS = [
+    (".gz", lambda d: gzip.compress(d, compresslevel=9, mtime=0)),
+    (".br", lambda d: brotli.compress(d, quality=9)),
+]
+
+
+def write_data_file(name, extension, content):
+    """
+    Write content to dist/data under a name containing its hash, together with gzip and brotli compressed copies.
+    Returns the URL of the uncompressed file. Files that already exist are only touched, as their content is the same.
+    """
+    data = content.encode("utf-8")
+    filename = f"{name}.{hashlib.sha256(data).hexdigest()[:16]}{extension}"
+    path = os.path.join(data_dir, filename)
+
+    for suffix, compress in [("", lambda d: d), *COMPRESSIONS]:
+        if os.path.exists(path + suffix):
+            os.utime(path + suffix)
+            continue
+        # the same file may be written by a parallel render of another language
+        with tempfile.NamedTemporaryFile(dir=data_dir, delete=False) as f:
+            f.write(compress(data))
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path + suffix)
+
+    return f"/data/{filename}"
+
+
+def prune_data_files():
+    """Remove data files that no page references anymore, once clients with an older page had time to load them."""
+    referenced = set()
+    for lang in ALL_LANGS:
+        for page in ["index.html", "light.html"]:
+            path = os.path.join(get_dist_dir(lang), page)
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    referenced.update(re.findall(r"/data/([\w.-]+)", f.read()))
+
+    for filename in os.listdir(data_dir):
+        path = os.path.join(data_dir, filename)
+        base_filename = filename.removesuffix(".gz").removesuffix(".br")
+        if base_filename not in referenced and time.time() - os.path.getmtime(path) > DATA_FILE_RETENTION:
+            os.remove(path)
+
+
+if SPLIT:
+    os.makedirs(data_dir, exist_ok=True)
+    script_url = write_data_file("out", ".js", hitch_script)
+    style_url = write_data_file("style", ".css", hitch_style)
+
+
+@functools.cache
+def get_environment(lang):
+    return Environment(loader=FileSystemLoader(get_template_dir(lang)))
+
+
+def write_if_changed(path, content):
+    """
+    Write content to path unless the file already has exactly this content, which keeps its mtime and caches valid.
+    The file is replaced atomically, so the server never sends a half written page. Returns whether it was written.
+    """
+    data = content.encode("utf-8") if isinstance(content, str) else content
+    if os.path.exists(path) and os.path.getsize(path) == len(data):
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+        f.write(data)
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+    return True
+
+
+def write_compressed_if_changed(path, content):
+    """Write content to path like write_if_changed, together with its compressed copies when it changed or they are missing."""
+    data = content.encode("utf-8")
+    written = write_if_changed(path, data)
+    for suffix, compress in COMPRESSIONS:
+        if written or not os.path.exists(path + suffix):
+            write_if_changed(path + suffix, compress(data))
+    return written
+
+
+def write_tiles(spots):
+    """Vector tiles of the spots in dist/tiles, tiles without spots are removed."""
+    tiles_dir = os.path.join(dist_dir_root, "tiles")
+    paths = set()
+    written = 0
+    for zoom in range(vectortiles.MAX_ZOOM + 1):
+        for (z, x, y), tile in vectortiles.aggregate(spots, zoom).items():
+            path = os.path.join(tiles_dir, str(z), str(x), f"{y}.mvt")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            written += write_if_changed(path, tile)
+            paths.add(path)
+
+    removed = 0
+    for directory, _subdirectories, filenames in os.walk(tiles_dir):
+        for filename in filenames:
+            if os.path.join(directory, filename) not in paths:
+                os.remove(os.path.join(directory, filename))
+                removed += 1
+    print(f"Tiles: {written} written, {len(paths) - written} unchanged, {removed} removed")
+
+
+page_jobs = []
+
+
+def render_page(i):
+    lang, template_name, path, context = page_jobs[i]
+    return write_if_changed(path, get_environment(lang).get_template(template_name).render(**context))
+
+
+def render_pages(jobs):
+    """Render (lang, template name, path, context) jobs, in a process pool unless the languages already render in parallel."""
+    global page_jobs
+    # forked workers inherit the jobs, so only their index is sent over and the contexts don't need to be picklable
+    page_jobs = jobs
+    with stage("render"):
+        if PARALLEL and len(langs_to_render) == 1:
+            with ProcessPoolExecutor(mp_context=multiprocessing.get_context("fork")) as pool:
+                written = list(pool.map(render_page, range(len(jobs)), chunksize=16))
+        else:
+            written = [render_page(i) for i in range(len(jobs))]
+    print(f"{sum(written)} pages written, {len(written) - sum(written)} unchanged")
+
+
+def render(lang):
+    """Render all pages of one language from the language independent points and places."""
+    print("LANG", lang)
+
+    dist_dir = get_dist_dir(lang)
+    os.makedirs(dist_dir, exist_ok=True)
+
+    template = get_environment(lang).get_template("index_template.html")
+
+    outname = get_outname(lang)
+    outname_recent = os.path.join(dist_dir, "recent.html")
+    outname_dups = os.path.join(dist_dir, "recent-dups.html")
+
+    if lang:
+        with stage("load"):
+            translations_df = pd.read_sql(
+                """SELECT point_id, translated_comment, is_original
+                FROM comment_translations
+                WHERE language = ?
+                """,
+                # a fresh connection, this may run in a forked process
+                get_db(),
+                params=(lang,),
+            )
+
+        # Merge translations with points
+        lang_points = points.merge(translations_df, left_on="id", right_on="point_id", how="left")
+
+        # Replace comment with translation where available, otherwise keep original
+        lang_points["comment"] = lang_points["translated_comment"].fillna(lang_points["comment"])
+
+        # Set is_original: True if no translation exists (NaN), otherwise use the value from translations
+        lang_points["is_original"] = lang_points["is_original"].fillna(True).astype(bool)
+
+        # Clean up temporary columns
+        lang_points.drop(columns=["point_id", "translated_comment"], inplace=True)
+    else:
+        lang_points = points.assign(is_original=True)
+
+    groups = lang_points.groupby("cluster_id")
+
+    print("After clustering:", len(groups), "Before:", len(lang_points.geometry.drop_duplicates()))
+
+    # Create individual review data with all fields needed for rendering
+    review_data = lang_points[
+        [
+            "lat",
+            "lon",
+            "rating",
+            "wait",
+            "comment",
+            "ride_distance",
+            "arrows",
+            "hitchhiker",
+            "datetime",
+            "ride_datetime",
+            "country",
+            "dest_lat",
+            "dest_lon",
+            "short_id",
+            "is_original",
+        ]
+    ].copy()
+
+    # Add a unique index for each review
+    review_data["review_index"] = review_data.index
+
+    # Convert to JSON-serializable format
+    with stage("encode"):
+        review_data_json = encode_columnar(review_data, REVIEW_ENCODINGS) if COLUMNAR else review_data.to_json(orient="values")
+        review_columns = review_data.columns.to_series().to_json(orient="values")
+
+    lang_places = places.copy()
+
+    # Store indices of reviews instead of the text
+    # positions shift whenever a review is added or removed, so these are always computed for all places
+    lang_places["review_indices"] = groups.apply(lambda g: g.index.tolist(), include_groups=False)
+
+    if LIGHT:
+        lang_places = lang_places[(lang_places.text.str.len() > 0) | ~lang_places.ride_distance.isnull()]
+    elif SERVICE_AREAS:
+        service_area_folder = os.path.join(dist_dir, "service-area")
+        os.makedirs(service_area_folder, exist_ok=True)
+        service_places = lang_places.loc[lang_places.service_area_name.notna()].copy()
+        service_places["text_len"] = service_places.text.str.len()
+        service_places["slug"] = service_places.service_area_name.apply(slugify)
+        service_places = service_places.sort_values("text_len", ascending=False).drop_duplicates("slug")
+        jobs = [
+            (
+                lang,
+                "service_template.html",
+                os.path.join(service_area_folder, f"{place['slug']}.html"),
+                {"place": place, "title": place["service_area_name"]},
+            )
+            for _i, place in service_places.iterrows()
+        ]
+        jobs.append(
+            (
+                lang,
+                "service_index.html",
+                os.path.join(service_area_folder, "index.html"),
+                {"grouped_places": service_places.groupby("country")},
+            )
+        )
+        render_pages(jobs)
+    elif CITIES:
+        lang_points.sort_values("datetime", inplace=True, ascending=False)
+        cities = pd.read_csv(os.path.join(db_dir, "cities.csv")).drop_duplicates().sort_values("city")
+        rendered_cities = []
+        jobs = []
+        postings = find_phrases(lang_points.comment, cities.city.tolist())
+
+        for city, city_postings in zip(cities.itertuples(), postings):
+            country_folder = os.path.join(dist_dir, "city", city.country)
+            os.makedirs(country_folder, exist_ok=True)
+            city_reviews = lang_points.iloc[city_postings[:20]]
+            rendered_cities.append(len(city_reviews) >= 3)
+            if rendered_cities[-1]:
+                jobs.append(
+                    (
+                        lang,
+                        "city_template.html",
+                        os.path.join(country_folder, f"{city.city}.html"),
+                        {"city": city, "title": city.city, "reviews": city_reviews},
+                    )
+                )
+
+        print(rendered_cities)
+
+        jobs.append(
+            (
+                lang,
+                "city_index.html",
+                os.path.join(dist_dir, "city", "index.html"),
+                {"grouped_cities": cities[rendered_cities].groupby("country")},
+            )
+        )
+        render_pages(jobs)
+    elif COUNTRIES:
+        lang_points.sort_values("datetime", inplace=True, ascending=False)
+        countries = pd.read_csv(os.path.join(db_dir, "countries.csv")).drop_duplicates().sort_values("country")
+        rendered_countries = []
+        country_folder = os.path.join(dist_dir, "country")
+        os.makedirs(country_folder, exist_ok=True)
 
-if not LIGHT and not LANG:
-    recent = points.dropna(subset=["datetime"]).sort_values("datetime", ascending=False).iloc[:1000]
-    recent["url"] = "https://hitchmap.com/#" + recent.lat.astype(str) + "," + recent.lon.astype(str)
-    recent["text"] = points.comment.fillna("") + " " + points.extra_text.fillna("")
-    recent["hitchhiker"] = recent.hitchhiker.str.replace("://", "", regex=False)
-    recent["distance"] = recent["ride_distance"].round(1)
-    recent["datetime"] = recent["datetime"].astype(str)
-    recent["datetime"] += np.where(~recent.ride_datetime.isnull(), " 🕒", "")
+        jobs = []
+        postings = find_phrases(lang_points.comment, countries.name.tolist())
+
+        for country, country_postings in zip(countries.itertuples(), postings):
+            mention_reviews = lang_points.iloc[country_postings[:20]]
+            country_reviews = lang_points[lang_points.country == country.country].dropna(subset="comment").iloc[:20]
+            rendered_countries.append(len(mention_reviews) >= 3)
+            if rendered_countries[-1]:
+                jobs.append(
+                    (
+                        lang,
+                        "country_template.html",
+                        os.path.join(country_folder, f"{country.name}.html"),
+                        {
+                            "country": country,
+                            "title": country.country,
+                            "mention_reviews": mention_reviews,
+                            "country_reviews": country_reviews,
+                        },
+                    )
+                )
+        print(rendered_countries)
+        jobs.append(
+            (lang, "country_index.html", os.path.join(country_folder, "index.html"), {"countries": countries[rendered_countries]})
+        )
+        render_pages(jobs)
 
-    recent[["url", "country", "datetime", "hitchhiker", "rating", "distance", "text"]].to_html(
-        outname_recent, render_links=True, index=False
+    # z-index is rating + 2 * number of reviews + 2 * number of reviews with destination
+    lang_places["z-index"] = (
+        lang_places["rating"] + 2 * lang_places["review_count"] + 2 * lang_places["dest_lats"].str.len().fillna(0)
     )
 
-    duplicates["from_url"] = "https://hitchmap.com/#" + duplicates.from_lat.astype(str) + "," + duplicates.from_lon.astype(str)
-    duplicates["to_url"] = "https://hitchmap.com/#" + duplicates.to_lat.astype(str) + "," + duplicates.to_lon.astype(str)
-    duplicates[["id", "from_url", "to_url", "distance", "reviewed", "accepted"]].to_html(
-        outname_dups, render_links=True, index=False
+    lang_places.reset_index(inplace=True)
+    # make sure high-rated are on top
+    lang_places.sort_values("z-index", inplace=True, ascending=True)
+
+    with stage("encode"):
+        if COLUMNAR:
+            marker_data = encode_columnar(lang_places, MARKER_ENCODINGS)
+        else:
+            marker_data = lang_places[["lat", "lon", "rating", "text", "wait", "ride_distance", "review_indices"]].to_json(
+                orient="values"
+            )
+
+    if SPLIT:
+        with stage("write"):
+            page_data = {
+                "script_url": script_url,
+                "style_url": style_url,
+                # the language is part of the name, the service worker keeps one version per name
+                "markers_url": write_data_file(f"markers-{lang or 'default'}", ".json", marker_data),
+                "review_data_url": write_data_file(f"reviews-{lang or 'default'}", ".json", review_data_json),
+            }
+    else:
+        page_data = {
+            "hitch_script": hitch_script,
+            "hitch_style": hitch_style,
+            "markers": marker_data,
+            "review_data": review_data_json,
+        }
+
+    with stage("render"):
+        output = template.render(
+            {
+                **page_data,
+                "review_columns": review_columns,
+                "spot_tiles_url": SPOT_TILES_URL if TILES else None,
+                "generation_date": generation_date,
+            }
+        )
+
+    with stage("write"):
+        write_compressed_if_changed(outname, output)
+
+    if not LIGHT and not lang:
+        with stage("recent"):
+            recent = lang_points.dropna(subset=["datetime"]).sort_values("datetime", ascending=False).iloc[:1000]
+            recent["url"] = "https://hitchmap.com/#" + recent.lat.astype(str) + "," + recent.lon.astype(str)
+            recent["text"] = lang_points.comment.fillna("") + " " + lang_points.extra_text.fillna("")
+            recent["hitchhiker"] = recent.hitchhiker.str.replace("://", "", regex=False)
+            recent["distance"] = recent["ride_distance"].round(1)
+            recent["datetime"] = recent["datetime"].astype(str)
+            recent["datetime"] += np.where(~recent.ride_datetime.isnull(), " 🕒", "")
+
+            recent[["url", "country", "datetime", "hitchhiker", "rating", "distance", "text"]].to_html(
+                outname_recent, render_links=True, index=False
+            )
+
+            dups = duplicates.copy()
+            dups["from_url"] = "https://hitchmap.com/#" + dups.from_lat.astype(str) + "," + dups.from_lon.astype(str)
+            dups["to_url"] = "https://hitchmap.com/#" + dups.to_lat.astype(str) + "," + dups.to_lon.astype(str)
+            dups[["id", "from_url", "to_url", "distance", "reviewed", "accepted"]].to_html(
+                outname_dups, render_links=True, index=False
+            )
+
+
+if PARALLEL and len(langs_to_render) > 1:
+    # forked workers inherit the computed points and places, only the language is sent over
+    with ProcessPoolExecutor(len(langs_to_render), mp_context=multiprocessing.get_context("fork")) as pool:
+        list(pool.map(render, langs_to_render))
+else:
+    for lang in langs_to_render:
+        render(lang)
+
+if SPLIT:
+    prune_data_files()
+
+if not (SERVICE_AREAS or CITIES or COUNTRIES):
+    with stage("write"):
+        # remember what the pages were built from, so the next incremental run can skip or merge
+        with open(cache_file + ".tmp", "wb") as f:
+            pickle.dump(
+                {
+                    "cursor": cursor,
+                    "full_rebuild_time": full_rebuild_time,
+                    "points": points,
+                    "places": places,
+                    "replacements": replacements,
+                },
+                f,
+            )
+        os.replace(cache_file + ".tmp", cache_file)
+
+        spots = places[SPOT_COLUMNS].rename_axis("id").reset_index().astype({"id": "int64"})
+        spots.to_pickle(spots_file + ".tmp")
+        os.replace(spots_file + ".tmp", spots_file)
+
+        # the direction filter measures rides from the spot's marker, not from where the review was placed
+        reviews = points[REVIEW_COLUMNS].assign(
+            spot_id=points.cluster_id.astype("int64").values,
+            lat=places.lat.reindex(points.cluster_id).values,
+            lon=places.lon.reindex(points.cluster_id).values,
+        )
+        reviews.to_pickle(reviews_file + ".tmp")
+        os.replace(reviews_file + ".tmp", reviews_file)
+
+    if TILES:
+        with stage("tiles"):
+            write_tiles(spots)
+
+    con.executemany(
+        "insert or replace into show_state (job, cursor, updated_at) values (?, ?, ?)",
+        [(get_job_name(lang), json.dumps(lang_cursors[lang]), generation_date) for lang in langs_to_render],
     )
+    con.commit()
+
+touch_build_stamp()
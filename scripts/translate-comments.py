@@ -18,6 +18,7 @@ from tenacity import (
 )
 
 from helpers import get_db, root_dir
+from instrument import start_job, stage
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -79,6 +80,8 @@ async def get_translation(point_id: int, comment: str, rating: int, target_lang:
     return file_match.group(1).strip()
 
 
+start_job()
+
 # Connect to database
 db_conn = get_db()
 cursor = db_conn.cursor()
@@ -167,7 +170,9 @@ for target_lang_code, target_lang_name in TARGET_LANGUAGES.items():
 
         # Execute translations concurrently
         loop = asyncio.get_event_loop()
-        results = loop.run_until_complete(asyncio.gather(*[task for _, _, task in tasks], return_exceptions=True))
+        with stage("translate") as translate:
+            results = loop.run_until_complete(asyncio.gather(*[task for _, _, task in tasks], return_exceptions=True))
+            translate.rows = len(tasks)
 
         # Save results
         for (point_id, original_comment, _), result in zip(tasks, results):
@@ -18,6 +18,7 @@ from tenacity import (
 )
 
 from helpers import get_db, root_dir
+from instrument import start_job, stage
 from translatehelpers import correct_jinja_template
 
 # Set up logging
@@ -112,6 +113,8 @@ async def translate_and_validate(
             raise e
 
 
+start_job()
+
 # Connect to database
 db_conn = get_db()
 cursor = db_conn.cursor()
@@ -242,7 +245,9 @@ for target_lang_code, target_lang_name in TARGET_LANGUAGES.items():
 
         # Execute translations concurrently
         loop = asyncio.get_event_loop()
-        results = loop.run_until_complete(asyncio.gather(*[task for _, _, task in tasks], return_exceptions=True))
+        with stage("translate") as translate:
+            results = loop.run_until_complete(asyncio.gather(*[task for _, _, task in tasks], return_exceptions=True))
+            translate.rows = len(tasks)
 
         # Save results
         for (filename, original_content, _), result in zip(tasks, results):
@@ -0,0 +1,142 @@
+import struct
+
+import numpy as np
+import pandas as pd
+
+# Mapbox Vector Tiles (https://github.com/mapbox/vector-tile-spec) of the spots, written by show.py's tiles mode.
+# Tiles up to MAX_ZOOM - 1 have the spots aggregated on a grid, tiles at MAX_ZOOM have every spot,
+# clients overzoom those for the zoom levels after it.
+
+MAX_ZOOM = 8
+EXTENT = 4096
+# size of a grid cell in tile coordinates, 64 cells per tile side
+CELL_SIZE = 64
+LAYER = "spots"
+
+# the web mercator projection ends here
+MAX_LATITUDE = 85.0511287798
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def field(number, wire_type, payload):
+    """A protobuf field, payload is the encoded varint or fixed value, or the bytes of a length delimited field."""
+    key = varint((number << 3) | wire_type)
+    if wire_type == 2:
+        return key + varint(len(payload)) + payload
+    return key + payload
+
+
+def encode_value(value):
+    if isinstance(value, str):
+        return field(1, 2, value.encode("utf-8"))
+    if isinstance(value, (int, np.integer)):
+        return field(6, 0, varint(zigzag(int(value))))
+    return field(3, 1, struct.pack("<d", value))
+
+
+def encode_layer(name, features):
+    """features are (x, y, properties) with x, y in tile coordinates and properties a dict without nulls."""
+    keys, values = {}, {}
+    encoded_features = []
+    for x, y, properties in features:
+        tags = []
+        for key, value in properties.items():
+            # keyed by type too, 1 and 1.0 are equal in a dict but are different values in a tile
+            tags += [keys.setdefault(key, len(keys)), values.setdefault((type(value), value), len(values))]
+        # a single MoveTo command, 1 | (1 << 3), followed by the zigzag encoded position
+        geometry = [9, zigzag(int(x)), zigzag(int(y))]
+        encoded_features.append(
+            field(2, 2, b"".join(map(varint, tags))) + field(3, 0, varint(1)) + field(4, 2, b"".join(map(varint, geometry)))
+        )
+
+    return (
+        field(15, 0, varint(2))
+        + field(1, 2, name.encode("utf-8"))
+        + b"".join(field(2, 2, feature) for feature in encoded_features)
+        + b"".join(field(3, 2, key.encode("utf-8")) for key in keys)
+        + b"".join(field(4, 2, encode_value(value)) for _type, value in values)
+        + field(5, 0, varint(EXTENT))
+    )
+
+
+def encode_tile(features):
+    return field(3, 2, encode_layer(LAYER, features))
+
+
+def project(lat, lon):
+    """Web mercator position of lat, lon in [0, 1), x to the east and y to the south."""
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lon) + 180) / 360
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+    return np.clip(x, 0, 1 - 1e-12), np.clip(y, 0, 1 - 1e-12)
+
+
+def weighted_mean(values, weights, keys):
+    present = values.notna()
+    totals = (values[present] * weights[present]).groupby([key[present] for key in keys]).sum()
+    return totals / weights[present].groupby([key[present] for key in keys]).sum()
+
+
+def aggregate(spots, zoom):
+    """
+    The features of each tile at zoom: the spots themselves at MAX_ZOOM, otherwise one feature per grid cell with
+    the number of spots and reviews in it and the rating and wait averaged over its reviews.
+    """
+    x, y = project(spots.lat.to_numpy(), spots.lon.to_numpy())
+    world_x, world_y = x * (EXTENT << zoom), y * (EXTENT << zoom)
+    spots = spots.assign(
+        tile_x=(world_x // EXTENT).astype(int),
+        tile_y=(world_y // EXTENT).astype(int),
+        px=world_x % EXTENT,
+        py=world_y % EXTENT,
+    )
+
+    if zoom == MAX_ZOOM:
+        cells = spots.rename(columns={"id": "spot_id"})
+        columns = ["spot_id", "review_count", "rating", "wait", "ride_distance"]
+    else:
+        keys = [spots.tile_x, spots.tile_y, (spots.px // CELL_SIZE).astype(int), (spots.py // CELL_SIZE).astype(int)]
+        weights = spots.review_count.astype(float)
+        groups = spots.groupby(keys)
+        cells = pd.DataFrame(
+            {
+                "spot_count": groups.size(),
+                "review_count": groups.review_count.sum(),
+                # the marker goes to the review weighted center of the cell's spots
+                "px": (spots.px * weights).groupby(keys).sum() / weights.groupby(keys).sum(),
+                "py": (spots.py * weights).groupby(keys).sum() / weights.groupby(keys).sum(),
+                "rating": weighted_mean(spots.rating, weights, keys).round(2),
+                "wait": weighted_mean(spots.wait, weights, keys).round(1),
+            }
+        )
+        cells.index.names = ["tile_x", "tile_y", "cell_x", "cell_y"]
+        cells = cells.reset_index()
+        columns = ["spot_count", "review_count", "rating", "wait"]
+
+    tiles = {}
+    for (tile_x, tile_y), tile in cells.groupby(["tile_x", "tile_y"]):
+        features = []
+        for row in tile[["px", "py", *columns]].itertuples(index=False):
+            properties = {
+                column: int(value) if column.endswith(("_id", "_count")) else float(value)
+                for column, value in zip(columns, row[2:])
+                if pd.notna(value)
+            }
+            features.append((row.px, row.py, properties))
+        tiles[(zoom, tile_x, tile_y)] = encode_tile(features)
+    return tiles
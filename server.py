@@ -1,21 +1,36 @@
 import math
+import mimetypes
 import base64
+import json
 import os
 import random
 import re
 from datetime import datetime
+import numpy as np
 import pandas as pd
-import requests
 from flask import request, send_file, send_from_directory, jsonify, redirect
 from flask_security import current_user
-
-from backend.shared import app, db, root_dir, dist_dir, static_dir, EMAIL, logger
+from sqlalchemy import text
+
+from backend.shared import app, db, root_dir, dist_dir, static_dir
+from backend.metrics import metrics
+from backend.ratelimit import TokenBucketLimiter, RATE_LIMIT_PERIOD
+from backend.spots import get_spot_index
+from backend.reviews import get_review_index
+from backend.static import send_static
+from backend.country import get_country, enqueue_country_enrichment, UNKNOWN_COUNTRY
 from backend.user import init_security, security
 
+# tiles written by show.py's tiles mode
+mimetypes.add_type("application/vnd.mapbox-vector-tile", ".mvt")
+
 
 @app.route("/", methods=["GET"])
 def index():
-    return send_file(os.path.join(dist_dir, "index.html"))
+    response = send_static("")
+    if response is None:
+        return send_file(os.path.join(dist_dir, "index.html"))
+    return response
 
 
 @app.route("/.well-known/assetlinks.json", methods=["GET"])
@@ -28,6 +43,28 @@ def android_app():
     return send_file("android/Hitchmap.apk")
 
 
+LOCAL_IPS = ["localhost", "127.0.0.1"]
+RATE_LIMITED = (
+    "Rate limited. If you didn't submit multiple reviews in the last 10 seconds, your browser probably"
+    + "accidentally submitted the same review twice, and it will show up shortly."
+)
+rate_limiter = TokenBucketLimiter()
+
+# the not exists check is atomic with the insert and is answered from the points(ip, datetime) index (scripts/migrate.py)
+INSERT_POINT = text(
+    f"""
+    insert into points (id, rating, wait, comment, nickname, datetime, ip, reviewed, banned, lat, dest_lat, lon, dest_lon,
+        country, signal, ride_datetime, user_id)
+    select :id, :rating, :wait, :comment, :nickname, :datetime, :ip, false, false, :lat, :dest_lat, :lon, :dest_lon,
+        :country, :signal, :ride_datetime, :user_id
+    where not :check_recent or not exists (
+        select 1 from points where ip = :ip and datetime > datetime(:datetime, '-{RATE_LIMIT_PERIOD} seconds')
+    )
+    """
+)
+REVISE_POINT = text("UPDATE points SET revised_by = :pid WHERE id = :update_id AND user_id = :user_id AND revised_by is null")
+
+
 @app.route("/experience", methods=["POST"])
 def experience():
     data = request.form
@@ -63,78 +100,155 @@ def experience():
     assert -180 <= lon <= 180
     assert (-90 <= dest_lat <= 90 and -180 <= dest_lon <= 180) or (math.isnan(dest_lat) and math.isnan(dest_lon))
 
-    for _i in range(10):
-        resp = requests.get(
-            "https://nominatim.openstreetmap.org/reverse",
-            {
-                "lat": lat,
-                "lon": lon,
-                "format": "json",
-                "zoom": 3,
-                "email": EMAIL,
-            },
-        )
-        if resp.ok:
-            break
-        else:
-            logger.info(resp)
-
-    res = resp.json()
-    country = "XZ" if "error" in res else res["address"]["country_code"].upper()
+    # resolved locally so that submitting doesn't wait on Nominatim, which only fills in what the boundaries miss
+    country = get_country(lat, lon)
     pid = random.randint(0, 2**63)
     now = str(datetime.utcnow())
 
-    # rate limiting
-    # this might cause race conditions if the server ever runs on more than one thread
-    last10seconds = pd.read_sql(
-        "select * from points where ip = ? and datetime > datetime(?, '-10 seconds')", db.engine, params=(ip, now)
-    )
-    if ip not in ["localhost", "127.0.0.1"] and len(last10seconds) > 0:
-        return (
-            "Rate limited. If you didn't submit multiple reviews in the last 10 seconds, your browser probably"
-            + "accidentally submitted the same review twice, and it will show up shortly."
-        )
-
-    df = pd.DataFrame(
-        [
-            {
-                "rating": rating,
-                "wait": wait,
-                "comment": comment,
-                "nickname": nickname,
-                "datetime": now,
-                "ip": ip,
-                "reviewed": False,
-                "banned": False,
-                "lat": lat,
-                "dest_lat": dest_lat,
-                "lon": lon,
-                "dest_lon": dest_lon,
-                "country": country,
-                "signal": signal,
-                "ride_datetime": datetime_ride,
-                "user_id": current_user.id if not current_user.is_anonymous else None,
-            }
-        ],
-        index=[pid],
-    )
+    if ip not in LOCAL_IPS and not rate_limiter.allow(ip):
+        return RATE_LIMITED
+
+    point = {
+        "id": pid,
+        "rating": rating,
+        "wait": wait,
+        "comment": comment,
+        "nickname": nickname,
+        "datetime": now,
+        "ip": ip,
+        "lat": lat,
+        "dest_lat": None if math.isnan(dest_lat) else dest_lat,
+        "lon": lon,
+        "dest_lon": None if math.isnan(dest_lon) else dest_lon,
+        "country": country or UNKNOWN_COUNTRY,
+        "signal": signal,
+        "ride_datetime": datetime_ride,
+        "user_id": current_user.id if not current_user.is_anonymous else None,
+        # with several workers the in-process limiter doesn't see the others, so the insert checks the database too
+        "check_recent": app.config["RATE_LIMIT_SHARED"] and ip not in LOCAL_IPS,
+    }
     # Perform all database operations in a single transaction
-    with db.engine.connect() as conn:
-        with conn.begin():
-            # Insert new point
-            df.to_sql("points", conn, index_label="id", if_exists="append")
-            # If updating an existing point, check ownership and set revised_by in one statement
-            if update_id:
-                result = conn.execute(
-                    "UPDATE points SET revised_by = ? WHERE id = ? AND user_id = ? AND revised_by is null",
-                    [pid, old_id, current_user.id],
-                )
-                # Check if any row was actually updated, if not, roll back
-                assert result.rowcount == 1
+    with db.engine.begin() as conn:
+        if conn.execute(INSERT_POINT, point).rowcount == 0:
+            return RATE_LIMITED
+        # If updating an existing point, check ownership and set revised_by in one statement
+        if update_id:
+            result = conn.execute(REVISE_POINT, {"pid": pid, "update_id": update_id, "user_id": current_user.id})
+            # Check if any row was actually updated, if not, roll back
+            assert result.rowcount == 1
+
+    if country is None:
+        enqueue_country_enrichment(pid, lat, lon)
 
     return jsonify({"success": True})
 
 
+# spots returned per request at most, the most reviewed first
+SPOTS_LIMIT = 2000
+SPOTS_MAX_LIMIT = 10000
+SPOTS_MAX_RADIUS_KM = 500
+SPOTS_MAX_NEAREST = 100
+
+
+@app.route("/api/spots", methods=["GET"])
+def spots():
+    """
+    Spots in a bounding box (bbox=west,south,east,north), within radius km of lat, lon or the k nearest to lat, lon.
+    Each spot is a row in the order of columns, like the data embedded in the map.
+    """
+    index = get_spot_index()
+    if index is None:
+        return jsonify({"error": "Spots aren't available yet."}), 503
+
+    args = request.args
+    try:
+        limit = min(int(args.get("limit", SPOTS_LIMIT)), SPOTS_MAX_LIMIT)
+        if "bbox" in args:
+            west, south, east, north = map(float, args["bbox"].split(","))
+            assert -180 <= west <= 180 and -180 <= east <= 180 and -90 <= south <= north <= 90
+            result = index.bbox(west, south, east, north)
+        else:
+            lat, lon = float(args["lat"]), float(args["lon"])
+            assert -90 <= lat <= 90 and -180 <= lon <= 180
+            if "radius" in args:
+                result = index.radius(lat, lon, min(float(args["radius"]), SPOTS_MAX_RADIUS_KM))
+            else:
+                result = index.nearest(lat, lon, min(int(args.get("k", 1)), SPOTS_MAX_NEAREST))
+        assert limit > 0
+    except (KeyError, ValueError, AssertionError):
+        return jsonify({"error": "Pass bbox=west,south,east,north or lat, lon and optionally radius (km) or k."}), 400
+
+    body = (
+        f'{{"columns":{json.dumps(list(result.columns))},"truncated":{json.dumps(len(result) > limit)},'
+        f'"spots":{result.iloc[:limit].to_json(orient="values", double_precision=5)}}}'
+    )
+    response = app.response_class(body, mimetype="application/json")
+    # show.py updates the spots every minute
+    response.headers["Cache-Control"] = "public, max-age=60"
+    return response
+
+
+REVIEWS_LIMIT = 10000
+
+
+@app.route("/api/reviews/search", methods=["GET"])
+def search_reviews():
+    """
+    Reviews matching the filters of the map (js/filters.js): user (separated by ;), starttime, endtime, text,
+    mindistance and, with mydirection=true, direction and spread in degrees.
+    Returns the short ids of the matching reviews, newest first, and the ids of their spots, both up to limit.
+    """
+    index = get_review_index()
+    if index is None:
+        return jsonify({"error": "Reviews aren't available yet."}), 503
+
+    args = request.args
+    matches = []
+    try:
+        limit = min(int(args.get("limit", REVIEWS_LIMIT)), REVIEWS_LIMIT)
+        assert limit > 0
+        if args.get("user"):
+            users = [user.strip().lower() for user in args["user"].split(";") if user.strip()]
+            matches.append(index.user(users))
+        if args.get("starttime") or args.get("endtime"):
+            start, end = (pd.Timestamp(args[key]) if args.get(key) else None for key in ["starttime", "endtime"])
+            matches.append(index.ride_time(start, end))
+        if args.get("text"):
+            matches.append(index.text(args["text"]))
+        if args.get("mindistance"):
+            matches.append(index.min_distance(float(args["mindistance"])))
+        if args.get("mydirection") == "true":
+            direction, spread = float(args["direction"]), float(args.get("spread") or 70)
+            assert math.isfinite(direction) and 0 < spread < 180
+            matches.append(index.direction(direction, spread))
+        assert matches
+    except (KeyError, ValueError, AssertionError):
+        return jsonify({"error": "Pass at least one of user, starttime, endtime, text, mindistance or mydirection."}), 400
+
+    positions = matches[0]
+    for other in matches[1:]:
+        positions = np.intersect1d(positions, other, assume_unique=True)
+
+    positions, count = positions[:limit], len(positions)
+    return jsonify(
+        {
+            "count": count,
+            "truncated": count > limit,
+            "reviews": index.short_ids[positions].tolist(),
+            "spots": pd.unique(index.spot_ids[positions]).tolist(),
+        }
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Latency and database time per endpoint for Prometheus, only for requests from the server itself."""
+    # requests through nginx come from localhost too, but with the X-Real-IP of the client
+    if request.remote_addr not in LOCAL_IPS or request.headers.get("X-Real-IP"):
+        return "Not found", 404
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route("/original-comment/<short_id>")
 def original(short_id):
     pid = int.from_bytes(base64.urlsafe_b64decode(short_id), byteorder="big", signed=False)
@@ -146,6 +260,11 @@ def original(short_id):
 
 @app.route("/<path:path>")
 def serve_static(path):
+    # files written since the last build stamp aren't in the index yet
+    response = send_static(path)
+    if response is not None:
+        return response
+
     index_path = os.path.join(dist_dir, path, "index.html")
     if os.path.exists(index_path):
         if not path.endswith("/"):
@@ -3,5 +3,7 @@ source .venv/bin/activate
 
 pip install -r requirements.txt
 curl https://hitchmap.com/dump.sqlite > db/points.sqlite
+python scripts/migrate.py
+python scripts/fetch-countries.py
 npm install
 npm run build
\ No newline at end of file
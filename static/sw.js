@@ -86,6 +86,35 @@ self.addEventListener('fetch', (event) => {
         return urlObject.toString();
     }
     
+    // Content-addressed files (scripts/show.py split mode) never change, so they're served cache-first
+    const url = new URL(event.request.url);
+    if (url.hostname === self.location.hostname && url.pathname.startsWith('/data/')) {
+        event.respondWith(caches.open(cacheName).then((cache) => {
+            return cache.match(url.pathname).then((cachedResponse) => {
+                if (cachedResponse) {
+                    return cachedResponse;
+                }
+                return fetch(event.request).then(async (fetchedResponse) => {
+                    if (fetchedResponse.ok) {
+                        // Drop the older versions of this file, e.g. markers-en.<old hash>.json for markers-en.<new hash>.json
+                        const name = url.pathname.split('.')[0] + '.';
+                        // the names from before the language was part of them go too
+                        const oldNames = ['/data/markers.', '/data/reviews.'];
+                        for (const request of await cache.keys()) {
+                            const pathname = new URL(request.url).pathname;
+                            if (pathname.startsWith(name) || oldNames.some((oldName) => pathname.startsWith(oldName))) {
+                                await cache.delete(request);
+                            }
+                        }
+                        await cache.put(url.pathname, fetchedResponse.clone());
+                    }
+                    return fetchedResponse;
+                });
+            });
+        }));
+        return;
+    }
+
     // Open the cache
     event.respondWith(caches.open(cacheName).then((cache) => {
         const strippedUrl = stripQuery(event.request.url);